@@ -27,6 +27,8 @@ import logging
 import platform
 import collections
 import datetime
+import gzip
+import hashlib
 import pwd
 import os
 import json
@@ -36,6 +38,9 @@ import sys
 import threading
 import lib.config
 from lib.model.smartplugin import SmartPlugin
+from plugins import metrics
+
+from .logindex import LogIndex
 
 from jinja2 import Environment, FileSystemLoader
 
@@ -123,7 +128,8 @@ class BackendServer(SmartPlugin):
         }
         self._cherrypy = cherrypy
         self._cherrypy.config.update(config)
-        self._cherrypy.tree.mount(Backend(self, self.updates_allowed, language, self.developer_mode), '/', config = config)
+        self._backend = Backend(self, self.updates_allowed, language, self.developer_mode)
+        self._cherrypy.tree.mount(self._backend, '/', config = config)
 
     def run(self):
         self.logger.debug("BackendServer: rest run")
@@ -132,6 +138,7 @@ class BackendServer(SmartPlugin):
         self.logger.debug("BackendServer: engine started")
         #cherrypy.engine.block()
         self.alive = True
+        self._backend.item_tree_json()
 
     def stop(self):
         self.logger.debug("BackendServer: shutting down")
@@ -140,7 +147,8 @@ class BackendServer(SmartPlugin):
         self.alive = False
 
     def parse_item(self, item):
-        pass
+        # items are (re)loaded, the item tree has to be built again
+        self._backend.invalidate_item_tree()
 
     def parse_logic(self, logic):
         pass
@@ -245,6 +253,10 @@ class Backend:
         self.developer_mode = developer_mode
 
         self._sh_dir = self._sh.base_dir
+        self._log_index = LogIndex("%s/var/log/smarthome.log" % self._sh_dir)
+        # (etag, json, gzipped json) of the item tree, built on demand
+        self._item_tree = None
+        self._item_tree_lock = threading.Lock()
         self.visu_plugin = None
         self.visu_plugin_version = '1.0.0'
 
@@ -419,9 +431,18 @@ class Backend:
         """
         returns the smarthomeNG sqlite database as download
         """
+        if hasattr(self._sh.sql, 'dump_stream'):
+            # streamed from a snapshot, gzip compressed. without journal_mode wal the plugin
+            # returns no stream and logs that the dump is written to a file as before
+            stream = self._sh.sql.dump_stream()
+            if stream is not None:
+                cherrypy.response.headers['Content-Type'] = 'application/gzip'
+                cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="smarthomedb.dump.gz"'
+                return stream
         self._sh.sql.dump('%s/var/db/smarthomedb.dump'%self._sh_dir)
         mime = 'application/octet-stream'
         return cherrypy.lib.static.serve_file("%s/var/db/smarthomedb.dump"%self._sh_dir, mime, "%s/var/db/"%self._sh_dir)
+    db_dump_html._cp_config = {'response.stream': True}
 
     @cherrypy.expose
     def log_dump_html(self):
@@ -439,19 +460,9 @@ class Backend:
         """
         self.find_visu_plugin()
 
-        fobj = open("%s/var/log/smarthome.log" % self._sh_dir)
-        log_lines = []
-        start = (int(page)-1) * 1000
-        end = start + 1000
-        counter = 0
-        total_counter = 0
-        for line in fobj:
-            line_text = self.html_escape(line)
-            if (log_level_filter == "ALL" or line_text.find(log_level_filter) in [19, 20, 21, 22, 23]) and text_filter in line_text:
-                if start <= counter < end:
-                    log_lines.append(line_text)
-                counter += 1
-        fobj.close()
+        self._log_index.update()
+        log_lines, counter = self._log_index.page(log_level_filter, text_filter, max(int(page) - 1, 0), 1000)
+        log_lines = [self.html_escape(line) for line in log_lines]
         num_pages = -(-counter // 1000)
         if num_pages == 0:
             num_pages = 1
@@ -482,24 +493,49 @@ class Backend:
         self.find_visu_plugin()
         
         tmpl = self.env.get_template('items.html')
-        return tmpl.render( smarthome = self._sh, items=sorted(self._sh.return_items(),key=lambda k: str.lower(k['_path']), reverse=False), visu_plugin=(self.visu_plugin is not None))
+        return tmpl.render( smarthome = self._sh, visu_plugin=(self.visu_plugin is not None))
 
     @cherrypy.expose
     def items_json_html(self):
         """
         returns a list of items as json structure
         """
-        items_sorted = sorted(self._sh.return_items(),key=lambda k: str.lower(k['_path']), reverse=False)
-        parent_items_sorted = []
-        last_parent_item = None
-        for item in items_sorted:
-            if last_parent_item is None or last_parent_item._path not in item._path:
-                parent_items_sorted.append(item)
-                last_parent_item = item
-
-        item_data = self._build_item_tree(parent_items_sorted)
-
-        return json.dumps(item_data)
+        etag, data, compressed = self.item_tree_json()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return b''
+        if 'gzip' in cherrypy.request.headers.get('Accept-Encoding', ''):
+            cherrypy.response.headers['Content-Encoding'] = 'gzip'
+            return compressed
+        return data
+
+    def item_tree_json(self):
+        """
+        returns etag, json and gzipped json of the item tree, which is only built again after items are loaded
+        """
+        with self._item_tree_lock:
+            if self._item_tree is None:
+                items_sorted = sorted(self._sh.return_items(),key=lambda k: str.lower(k['_path']), reverse=False)
+                parent_items_sorted = []
+                last_parent_item = None
+                for item in items_sorted:
+                    if last_parent_item is None or last_parent_item._path not in item._path:
+                        parent_items_sorted.append(item)
+                        last_parent_item = item
+
+                item_data = self._build_item_tree(parent_items_sorted)
+
+                data = json.dumps(item_data).encode()
+                etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+                self._item_tree = (etag, data, gzip.compress(data))
+            return self._item_tree
+
+    def invalidate_item_tree(self):
+        with self._item_tree_lock:
+            self._item_tree = None
 
     @cherrypy.expose
     def cache_check_json_html(self):
@@ -527,6 +563,22 @@ class Backend:
 
         return json.dumps(not_item_related_cache_files)
 
+    @cherrypy.expose
+    def metrics(self):
+        """
+        returns the metrics of the plugins in the Prometheus text format
+        """
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.registry.prometheus().encode()
+
+    @cherrypy.expose
+    def metrics_json_html(self):
+        """
+        returns the metrics of the plugins as json structure
+        """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(metrics.registry.export()).encode()
+
     @cherrypy.expose
     def item_change_value_html(self, item_path, value):
         """
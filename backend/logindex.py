@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+#########################################################################
+#  Copyright 2016 Bernd Meiners,
+#                 Christian Strassburg            c.strassburg@gmx.de
+#                 René Frieß                      rene.friess@gmail.com
+#                 Martin Sinn                     m.sinn@gmx.de
+#########################################################################
+#  Backend plugin for SmartHomeNG
+#
+#  This plugin is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This plugin is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this plugin. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import array
+import collections
+import os
+import threading
+
+LEVELS = [b'DEBUG', b'INFO', b'WARNING', b'ERROR', b'CRITICAL']
+
+
+class LogIndex:
+    """
+    Offsets of the lines of a logfile, so a page of the log is read by seeking.
+
+    The index grows with the file and is rebuilt when the file is rotated. Lines
+    are additionally indexed by the log level found at column 19 to 23.
+    """
+
+    chunk = 10000  # lines read at once when filtering by text
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self._inode = inode
+        self.size = 0
+        self.offsets = array.array('q')
+        self.levels = {level.decode(): array.array('l') for level in LEVELS}
+        # (level, text) -> [candidates scanned, matching line numbers]
+        self._filters = collections.OrderedDict()
+
+    def update(self):
+        """
+        indexes the lines added since the last update
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.filename)
+            except OSError:
+                self._reset(None)
+                return
+            if stat.st_ino != self._inode or stat.st_size < self.size:
+                self._reset(stat.st_ino)
+            if stat.st_size == self.size:
+                return
+            with open(self.filename, 'rb') as f:
+                f.seek(self.size)
+                position = self.size
+                rest = b''
+                while True:
+                    block = f.read(1 << 20)
+                    if not block:
+                        break
+                    data = rest + block
+                    start = 0
+                    while True:
+                        end = data.find(b'\n', start)
+                        if end < 0:
+                            break
+                        self._add(position + start, data[start + 19:start + 32])
+                        start = end + 1
+                    position += start
+                    rest = data[start:]
+            self.size = position  # an incomplete last line is indexed with the next update
+
+    def _add(self, offset, head):
+        number = len(self.offsets)
+        self.offsets.append(offset)
+        for level in LEVELS:
+            if 0 <= head.find(level) <= 4:
+                self.levels[level.decode()].append(number)
+                break
+
+    def _read(self, f, numbers):
+        # consecutive lines are read with one seek
+        lines = []
+        i = 0
+        while i < len(numbers):
+            j = i
+            while j + 1 < len(numbers) and numbers[j + 1] == numbers[j] + 1:
+                j += 1
+            start = self.offsets[numbers[i]]
+            end = self.offsets[numbers[j] + 1] if numbers[j] + 1 < len(self.offsets) else self.size
+            f.seek(start)
+            lines.extend(line.decode(errors='replace') for line in f.read(end - start).split(b'\n')[:-1])
+            i = j + 1
+        return lines
+
+    def page(self, level='ALL', text='', page=0, size=1000):
+        """
+        returns the lines of a page and the number of all lines matching level and text
+        """
+        with self._lock:
+            if level == 'ALL':
+                candidates = range(len(self.offsets))
+            else:
+                candidates = self.levels.get(level, [])
+            with open(self.filename, 'rb') as f:
+                if text != '':
+                    candidates = self._filter(f, level, text, candidates)
+                return self._read(f, candidates[page * size:(page + 1) * size]), len(candidates)
+
+    def _filter(self, f, level, text, candidates):
+        # the matches of the last filters are kept, only lines added since are searched
+        key = (level, text)
+        if key in self._filters:
+            self._filters.move_to_end(key)
+        else:
+            self._filters[key] = [0, array.array('l')]
+            if len(self._filters) > 8:
+                self._filters.popitem(last=False)
+        scanned, matches = self._filters[key]
+        for first in range(scanned, len(candidates), self.chunk):
+            numbers = candidates[first:first + self.chunk]
+            for number, line in zip(numbers, self._read(f, numbers)):
+                if text in line:
+                    matches.append(number)
+        self._filters[key][0] = len(candidates)
+        return matches
@@ -19,34 +19,86 @@
 #  along with SmartHome.py.  If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import json
 import logging
+import queue
 import threading
+import time
 import lib.connection
 
 
 
 class CLIHandler(lib.connection.Stream):
     terminator = '\n'.encode()
+    chunk = 16384  # output is collected and sent in chunks of this size
+    backlog = 65536  # bytes queued for the socket before the output waits for the client
 
     def __init__(self, smarthome, sock, source, updates):
         lib.connection.Stream.__init__(self, sock, source)
+        self.logger = logging.getLogger(__name__)
         self.source = source
         self.updates_allowed = updates
         self.sh = smarthome
+        self._output = []
+        self._output_size = 0
+        self._alive = True
+        # commands run in a thread of their own, so long listings don't block the connection loop
+        self._commands = queue.Queue()
+        worker = threading.Thread(target=self._worker, name='CLI {0}'.format(source))
+        worker.daemon = True
+        worker.start()
         self.push("SmartHome.py v{0}\n".format(self.sh.version))
         self.push("Enter 'help' for a list of available commands.\n")
         self.push("> ")
+        self.flush()
 
     def push(self, data):
-        self.send(data.encode())
+        self._output.append(data)
+        self._output_size += len(data)
+        if self._output_size >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self._output:
+            return
+        data = ''.join(self._output).encode()
+        self._output = []
+        self._output_size = 0
+        self.send(data)
+        # wait until the client has read enough of the output
+        while self._alive and self._backlog() > self.backlog:
+            time.sleep(0.01)
+
+    def _backlog(self):
+        # bytes queued by lib.connection.Stream.send and not yet written to the socket
+        return sum(len(data) for data in list(getattr(self, 'outbuffer', ())))
+
+    def handle_close(self):
+        self._alive = False
+        self._commands.put(None)
 
     def found_terminator(self, data):
-        cmd = data.decode().strip()
+        self._commands.put(data.decode().strip())
+
+    def _worker(self):
+        while True:
+            cmd = self._commands.get()
+            if cmd is None or not self._alive:
+                return
+            try:
+                self.command(cmd)
+            except Exception as e:
+                self.logger.warning("CLI: problem executing '{0}': {1}".format(cmd, e))
+                self.push("Error: {0}\n> ".format(e))
+            self.flush()
+
+    def command(self, cmd):
         if cmd.startswith('ls'):
-            self.push("Items:\n======\n")
-            self.ls(cmd.lstrip('ls').strip(), '*' in cmd or ':' in cmd)
-        elif cmd == 'la':
-            self.la()
+            path, offset, limit, as_json = self._options(cmd.lstrip('ls'))
+            self.ls(path, '*' in path or ':' in path, offset, limit, as_json)
+        elif cmd == 'la' or cmd.startswith('la '):
+            path, offset, limit, as_json = self._options(cmd[2:])
+            self.la(offset, limit, as_json)
         elif cmd == 'lo':
             self.lo()
         elif cmd == 'll':
@@ -58,7 +110,8 @@ class CLIHandler(lib.connection.Stream):
         elif cmd.startswith('update ') or cmd.startswith('up '):
             self.update(cmd.lstrip('update').strip())
         elif cmd.startswith('dump'):
-            self.dump(cmd.lstrip('dump').strip(), '*' in cmd or ':' in cmd)
+            path, offset, limit, as_json = self._options(cmd.lstrip('dump'))
+            self.dump(path, '*' in path or ':' in path, offset, limit, as_json)
         elif cmd.startswith('tr'):
             self.tr(cmd.lstrip('tr').strip())
         elif cmd.startswith('rl'):
@@ -71,44 +124,89 @@ class CLIHandler(lib.connection.Stream):
             self.usage()
         elif cmd in ('quit', 'q', 'exit', 'x'):
             self.push('bye\n')
+            self.flush()
             self.close()
             return
         self.push("> ")
 
+    def _options(self, args):
+        # splits 'path [offset [limit]] [--json]' into path, offset, limit and json mode
+        args = args.split()
+        as_json = '--json' in args
+        args = [arg for arg in args if arg != '--json']
+        numbers = []
+        while args and args[-1].isdigit() and len(numbers) < 2:
+            numbers.insert(0, int(args.pop()))
+        offset = numbers[0] if numbers else 0
+        limit = numbers[1] if len(numbers) > 1 else None
+        return ' '.join(args), offset, limit, as_json
+
+    def _list(self, items, offset=0, limit=None, as_json=False, text=None, entry=None):
+        # pushes the items from offset on, at most limit of them, as text lines or as one json list
+        end = None if limit is None else offset + limit
+        total = 0
+        opened = False
+        for item in items:
+            if total >= offset and (end is None or total < end):
+                if as_json:
+                    self.push((',' if opened else '[') + json.dumps(entry(item), default=str))
+                    opened = True
+                else:
+                    self.push(text(item))
+            total += 1
+        if as_json:
+            self.push(']\n' if opened else '[]\n')
+        elif limit is not None or offset:
+            shown = max(0, (total if end is None else min(total, end)) - offset)
+            self.push("-- {0} of {1} shown from {2}".format(shown, total, offset))
+            if end is not None and end < total:
+                self.push(", continue with offset {0}".format(end))
+            self.push(" --\n")
+
+    def _item_line(self, item):
+        if item.type():
+            return "{0} = {1}\n".format(item.id(), item())
+        return "{0}\n".format(item.id())
+
+    def _item_entry(self, item):
+        if item.type():
+            return {'id': item.id(), 'type': item.type(), 'value': item()}
+        return {'id': item.id()}
+
+    def _walk(self, item):
+        # the item and all its children, without looking them up by their path
+        yield item
+        for child in item:
+            yield from self._walk(child)
+
     def cl(self):
         self.sh.log.clean(self.sh.now())
 
-    def ls(self, path, match=True):
+    def ls(self, path, match=True, offset=0, limit=None, as_json=False):
+        if not as_json:
+            self.push("Items:\n======\n")
         if not path:
-            for item in self.sh:
-                self.push("{0}\n".format(item.id()))
+            self._list(self.sh, offset, limit, as_json, lambda item: "{0}\n".format(item.id()), lambda item: {'id': item.id()})
+            return
+        if match:
+            items = self.sh.match_items(path)
         else:
-            if match:
-               items = self.sh.match_items(path)
-               childs = False
-            else:
-               items = [self.sh.return_item(path)]
-               childs = True
-            if len(items):
-                for item in items:
-                    if hasattr(item, 'id'):
-                        if item.type():
-                            self.push("{0} = {1}\n".format(item.id(), item()))
-                        else:
-                            self.push("{}\n".format(item.id()))
-                        if childs:
-                            for child in item:
-                                self.ls(child.id(), False)
+            items = [self.sh.return_item(path)]
+        items = [item for item in items if hasattr(item, 'id')]
+        if not items:
+            if as_json:
+                self.push('[]\n')
             else:
                 self.push("Could not find path: {}\n".format(path))
+            return
+        if not match:
+            items = self._walk(items[0])
+        self._list(items, offset, limit, as_json, self._item_line, self._item_entry)
 
-    def la(self):
-        self.push("Items:\n======\n")
-        for item in self.sh.return_items():
-            if item.type():
-                self.push("{0} = {1}\n".format(item.id(), item()))
-            else:
-                self.push("{0}\n".format(item.id()))
+    def la(self, offset=0, limit=None, as_json=False):
+        if not as_json:
+            self.push("Items:\n======\n")
+        self._list(self.sh.return_items(), offset, limit, as_json, self._item_line, self._item_entry)
 
     def update(self, data):
         if not self.updates_allowed:
@@ -130,41 +228,63 @@ class CLIHandler(lib.connection.Stream):
         else:
             self.push("Could not find any item with given pattern: '{0}'\n".format(path))
 
-    def dump(self, path, match=True):
+    def dump(self, path, match=True, offset=0, limit=None, as_json=False):
         if match:
             items = self.sh.match_items(path)
         else:
             items = [self.sh.return_item(path)]
         if len(items):
-            for item in items:
-                if hasattr(item, 'id') and item._type:
-                    self.push("Item {} ".format(item.id()))
-                    self.push("{\n")
-                    self.push("  type = {}\n".format(item.type()))
-                    self.push("  value = {}\n".format(item()))
-                    self.push("  age = {}\n".format(item.age()))
-                    self.push("  last_change = {}\n".format(item.last_change()))
-                    self.push("  changed_by = {}\n".format(item.changed_by()))
-                    self.push("  previous_value = {}\n".format(item.prev_value()))
-                    self.push("  previous_age = {}\n".format(item.prev_age()))
-                    self.push("  previous_change = {}\n".format(item.prev_change()))
-                    if hasattr(item, 'conf'):
-                        self.push("  config = {\n")
-                        for name in item.conf:
-                            self.push("    {} = {}\n".format(name, item.conf[name]))
-                        self.push("  }\n")
-                    self.push("  logics = [\n")
-                    for trigger in item.get_logic_triggers():
-                        self.push("    {}\n".format(trigger))
-                    self.push("  ]\n")
-                    self.push("  triggers = [\n")
-                    for trigger in item.get_method_triggers():
-                        self.push("    {}\n".format(trigger))
-                    self.push("  ]\n")
-                    self.push("}\n")
+            items = [item for item in items if hasattr(item, 'id') and item._type]
+            self._list(items, offset, limit, as_json, self._dump_text, self._dump_entry)
+        elif as_json:
+            self.push('[]\n')
         else:
             self.push("Nothing found\n")
 
+    def _dump_text(self, item):
+        lines = ["Item {} {{\n".format(item.id())]
+        lines.append("  type = {}\n".format(item.type()))
+        lines.append("  value = {}\n".format(item()))
+        lines.append("  age = {}\n".format(item.age()))
+        lines.append("  last_change = {}\n".format(item.last_change()))
+        lines.append("  changed_by = {}\n".format(item.changed_by()))
+        lines.append("  previous_value = {}\n".format(item.prev_value()))
+        lines.append("  previous_age = {}\n".format(item.prev_age()))
+        lines.append("  previous_change = {}\n".format(item.prev_change()))
+        if hasattr(item, 'conf'):
+            lines.append("  config = {\n")
+            for name in item.conf:
+                lines.append("    {} = {}\n".format(name, item.conf[name]))
+            lines.append("  }\n")
+        lines.append("  logics = [\n")
+        for trigger in item.get_logic_triggers():
+            lines.append("    {}\n".format(trigger))
+        lines.append("  ]\n")
+        lines.append("  triggers = [\n")
+        for trigger in item.get_method_triggers():
+            lines.append("    {}\n".format(trigger))
+        lines.append("  ]\n")
+        lines.append("}\n")
+        return ''.join(lines)
+
+    def _dump_entry(self, item):
+        entry = {
+            'id': item.id(),
+            'type': item.type(),
+            'value': item(),
+            'age': item.age(),
+            'last_change': item.last_change(),
+            'changed_by': item.changed_by(),
+            'previous_value': item.prev_value(),
+            'previous_age': item.prev_age(),
+            'previous_change': item.prev_change(),
+            'logics': [str(trigger) for trigger in item.get_logic_triggers()],
+            'triggers': [str(trigger) for trigger in item.get_method_triggers()],
+        }
+        if hasattr(item, 'conf'):
+            entry['config'] = item.conf
+        return entry
+
     def tr(self, logic):
         if not self.updates_allowed:
             self.push("Logic triggering is not allowed.\n")
@@ -219,6 +339,8 @@ class CLIHandler(lib.connection.Stream):
         self.push('ls: list the first level items\n')
         self.push('ls item: list item and every child item (with values)\n')
         self.push('la: list all items (with values)\n')
+        self.push('la offset limit: list limit items starting at offset, also for ls and dump\n')
+        self.push('la --json: list as one json document, also for ls and dump\n')
         self.push('lo: list all logics and next execution time\n')
         self.push('lt: list current thread names\n')
         self.push('update item = value: update the specified item with the specified value\n')
@@ -20,9 +20,13 @@
 #
 
 import logging
+import re
+import string
 import time
 import threading
 
+from . import columnar
+
 logger = logging.getLogger('')
 
 
@@ -33,6 +37,8 @@ class DataLog():
     _items = {}
     _buffer = {}
     _buffer_lock = None
+    # positions of the placeholders in a compiled log pattern
+    _fields = {'time': 0, 'stamp': 1, 'item': 2, 'value': 3}
 
     def __init__(self, smarthome, path="var/log/data", filepatterns={ "default" : "{log}-{year}-{month}-{day}.csv" }, logpatterns={ "csv" : "{time};{item};{value}\n" }, cycle=10):
         self._sh = smarthome
@@ -52,19 +58,28 @@ class DataLog():
                 newlogpatterns[key] = value
             logpatterns = newlogpatterns
 
+        # logs to files with the extension .col are written in the columnar binary format
+        self._columnar = set()
         for log in self.filepatterns:
             ext = self.filepatterns[log].split('.')[-1]
-            if ext in logpatterns:
+            if ext == 'col':
+                self._columnar.add(log)
+            elif ext in logpatterns:
                 self.logpatterns[log] = logpatterns[ext]
 
         self.cycle = int(cycle)
         self._items = {}
         self._buffer = {}
         self._buffer_lock = threading.Lock()
-        
+        # log -> (template, uses stamp), log -> (day, open file)
+        self._templates = {}
+        for log in self.logpatterns:
+            self._templates[log] = self._compile(self.logpatterns[log])
+        self._handles = {}
+
         logger.info('DataLog: Initialized, logging to "{}"'.format(self.path))
         for log in self.filepatterns:
-            logger.info('DataLog: Registered log "{}", file="{}", format="{}"'.format(log, self.filepatterns[log], self.logpatterns[log]))
+            logger.info('DataLog: Registered log "{}", file="{}", format="{}"'.format(log, self.filepatterns[log], 'columnar' if log in self._columnar else self.logpatterns[log]))
 
     def run(self):
         self.alive = True
@@ -73,6 +88,30 @@ class DataLog():
     def stop(self):
         self.alive = False
         self._dump()
+        for log in list(self._handles):
+            self._handles.pop(log)[1].close()
+
+    def _compile(self, pattern):
+        # replace the named placeholders by positional ones, an entry is then written with one format call
+        template = ''
+        stamp = False
+        for literal, field, spec, conversion in string.Formatter().parse(pattern):
+            template += literal.replace('{', '{{').replace('}', '}}')
+            if field is None:
+                continue
+            name, attribute = re.match(r'(\w*)(.*)', field).groups()
+            if name not in self._fields:
+                logger.warning('DataLog: Unknown placeholder "{}" in log pattern "{}"'.format(field, pattern))
+                template += '{{' + field + '}}'
+                continue
+            stamp = stamp or name == 'stamp'
+            template += '{' + str(self._fields[name]) + attribute
+            if conversion:
+                template += '!' + conversion
+            if spec:
+                template += ':' + spec
+            template += '}'
+        return template, stamp
 
     def parse_item(self, item):
         if 'datalog' in item.conf:
@@ -110,14 +149,11 @@ class DataLog():
             pass
 
         if item.id() in self._items:
+            entry = (self._sh.now(), item.id(), item())
             for log in self._items[item.id()]:
-                self._buffer[log].append({ 'time' : self._sh.now(), 'item' : item.id(), 'value' : item() })
+                self._buffer[log].append(entry)
 
     def _dump(self):
-        data = {}
-        now = self._sh.now()
-        handles = {}
-
         for log in self._buffer:
             self._buffer_lock.acquire()
             logger.debug('Dumping log "{}" with {} entries ...'.format(log, len(self._buffer[log])))
@@ -125,25 +161,42 @@ class DataLog():
             self._buffer[log] = []
             self._buffer_lock.release()
 
-            if len(entries):
-                logpattern = self.logpatterns[log]
-
+            if len(entries) and (log in self._templates or log in self._columnar):
                 try:
-                    for entry in entries:
-                        filename = self.filepatterns[log].format(**{ 'log' : log, 'year' : entry['time'].year, 'month' : entry['time'].month, 'day' : entry['time'].day })
-
-                        if filename not in handles:
-                            handles[filename] = open(self.path + '/' + filename, 'a')
-
-                        data = entry
-                        data['stamp'] = data['time'].time();
-                        handles[filename].write(logpattern.format(**data))
+                    day = entries[0][0].date()
+                    first = 0
+                    for index, entry in enumerate(entries):
+                        if entry[0].date() != day:
+                            self._write(log, day, entries[first:index])
+                            day = entry[0].date()
+                            first = index
+                    self._write(log, day, entries[first:])
 
                 except Exception as e:
-                    logger.error('Error while writing to {}: {}'.format(filename, e))
+                    logger.error('Error while writing log "{}": {}'.format(log, e))
 
-        for filename in handles:
-            handles[filename].close()
+        # close the files of past days
+        today = self._sh.now().date()
+        for log in [log for log in self._handles if self._handles[log][0] != today]:
+            self._handles.pop(log)[1].close()
 
         logger.debug('Dump done!')
 
+    def _write(self, log, day, entries):
+        # the file of a log stays open until the day changes
+        if log not in self._handles or self._handles[log][0] != day:
+            if log in self._handles:
+                self._handles.pop(log)[1].close()
+            filename = self.path + '/' + self.filepatterns[log].format(**{ 'log' : log, 'year' : day.year, 'month' : day.month, 'day' : day.day })
+            if log in self._columnar:
+                self._handles[log] = (day, columnar.ColumnarFile(filename))
+            else:
+                self._handles[log] = (day, open(filename, 'a'))
+        handle = self._handles[log][1]
+        if log in self._columnar:
+            handle.append(entries)
+            return
+        template, stamp = self._templates[log]
+        handle.writelines([template.format(when, when.time() if stamp else None, item, value) for when, item, value in entries])
+        handle.flush()
+
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#
+# Copyright 2013 KNX-User-Forum e.V.            http://knx-user-forum.de/
+#
+#  This file is part of SmartHome.py.    http://mknx.github.io/smarthome/
+#
+#  SmartHome.py is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHome.py is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHome.py. If not, see <http://www.gnu.org/licenses/>.
+#
+# Columnar binary log files.
+#
+# A file starts with MAGIC and is followed by blocks, one per dump:
+#
+#   header   '<4sII4x'   b'DLB\0', length of the names, number of entries n
+#   names    utf-8 ids of the items new in this file, '\n' separated, padded to 8 bytes
+#   times    n * '<i8'   milliseconds since the epoch
+#   values   n * '<f8'
+#   ids      n * '<u4'   position of the item in the names of the file, padded to 8 bytes
+#
+# Blocks are only appended, an incomplete block at the end of a file is ignored
+# by the reader and cut off by the writer.
+
+import logging
+import os
+import struct
+
+logger = logging.getLogger('')
+
+MAGIC = b'SHDLCOL1'
+BLOCK = struct.Struct('<4sII4x')
+BLOCK_MAGIC = b'DLB\x00'
+
+
+def _pad(length):
+    return (length + 7) & ~7
+
+
+def _blocks(f, size):
+    # yields names, count, offset of the columns and end of every complete block
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('{} is no columnar datalog file'.format(f.name))
+    offset = len(MAGIC)
+    while offset + BLOCK.size <= size:
+        f.seek(offset)
+        magic, length, count = BLOCK.unpack(f.read(BLOCK.size))
+        columns = offset + BLOCK.size + length
+        end = columns + _pad(20 * count)
+        if magic != BLOCK_MAGIC or end > size:
+            break
+        names = f.read(length).rstrip(b'\x00')
+        names = names.decode().split('\n') if names else []
+        yield names, count, columns, end
+        offset = end
+
+
+class ColumnarFile():
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.ids = {}
+        self._file = open(filename, 'a+b')
+        size = self._file.seek(0, 2)
+        if size == 0:
+            self._file.write(MAGIC)
+            return
+        end = len(MAGIC)
+        try:
+            for names, count, columns, end in _blocks(self._file, size):
+                for name in names:
+                    self.ids[name] = len(self.ids)
+        except ValueError as e:
+            # a truncated or foreign header, keep the file for inspection and start a new one
+            logger.error('DataLog: {}, moving it to {}.bad'.format(e, filename))
+            self._file.close()
+            os.replace(filename, filename + '.bad')
+            self.ids = {}
+            self._file = open(filename, 'a+b')
+            self._file.write(MAGIC)
+            return
+        if end < size:
+            logger.warning('DataLog: Removing incomplete block at the end of {}'.format(filename))
+            self._file.truncate(end)
+
+    def append(self, entries):
+        names = []
+        times = []
+        values = []
+        ids = []
+        for when, item, value in entries:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue  # only numbers fit into the value column
+            if item not in self.ids:
+                self.ids[item] = len(self.ids)
+                names.append(item)
+            times.append(int(when.timestamp() * 1000))
+            values.append(value)
+            ids.append(self.ids[item])
+        if not ids:
+            return
+        names = '\n'.join(names).encode()
+        length = _pad(len(names))
+        count = len(ids)
+        block = BLOCK.pack(BLOCK_MAGIC, length, count) + names.ljust(length, b'\x00')
+        block += struct.pack('<{0}q{0}d{0}I'.format(count), *(times + values + ids))
+        self._file.write(block.ljust(_pad(len(block)), b'\x00'))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def items(filename):
+    """
+    Returns the ids of all items logged to a columnar file
+    """
+    with open(filename, 'rb') as f:
+        size = f.seek(0, 2)
+        return [name for names, count, columns, end in _blocks(f, size) for name in names]
+
+
+def read(filename, item, start=None, end=None):
+    """
+    Returns the times (milliseconds since the epoch) and the values of an item
+    logged to a columnar file as two NumPy arrays. start and end limit the times
+    to start <= time < end, both in milliseconds since the epoch.
+    """
+    import numpy  # only needed to read
+
+    if os.path.getsize(filename) <= len(MAGIC):
+        return numpy.empty(0, dtype='<i8'), numpy.empty(0, dtype='<f8')  # no blocks, nothing to map
+    data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+    times = []
+    values = []
+    ids = {}
+    with open(filename, 'rb') as f:
+        for names, count, columns, block_end in _blocks(f, len(data)):
+            for name in names:
+                ids[name] = len(ids)
+            if item not in ids:
+                continue
+            selected = data[columns + 16 * count:columns + 20 * count].view('<u4') == ids[item]
+            times.append(data[columns:columns + 8 * count].view('<i8')[selected])
+            values.append(data[columns + 8 * count:columns + 16 * count].view('<f8')[selected])
+    if not times:
+        return numpy.empty(0, dtype='<i8'), numpy.empty(0, dtype='<f8')
+    times = numpy.concatenate(times)
+    values = numpy.concatenate(values)
+    if start is not None or end is not None:
+        selected = numpy.ones(len(times), dtype=bool)
+        if start is not None:
+            selected &= times >= start
+        if end is not None:
+            selected &= times < end
+        times = times[selected]
+        values = values[selected]
+    return times, values
@@ -24,27 +24,36 @@
 
 import logging
 import threading
+import time
+import collections
+import os
 import struct
 import binascii
 
 import lib.connection
+from plugins import metrics
 from . import dpts
 
 KNXREAD = 0x00
 KNXRESP = 0x40
 KNXWRITE = 0x80
 
+# eibd/knxd cache read without falling back to a bus read
+EIB_CACHE_READ_NOWAIT = 0x75
+
+# send queue priorities
+PRIO_RESPONSE = 0
+PRIO_SEND = 1
+PRIO_STATUS = 2
+
 
 class KNX(lib.connection.Client):
 
-    def __init__(self, smarthome, time_ga=None, date_ga=None, send_time=False, busmonitor=False, host='127.0.0.1', port=6720, readonly=False, instance='default'):
+    def __init__(self, smarthome, time_ga=None, date_ga=None, send_time=False, busmonitor=False, host='127.0.0.1', port=6720, readonly=False, instance='default', send_rate=25, send_queue=500, init_window=10, init_timeout=2, init_retries=2, snapshot=True):
         lib.connection.Client.__init__(self, host, port, monitor=True)
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
-        self.gal = {}
-        self.gar = {}
-        self._init_ga = []
-        self._cache_ga = []
+        self._init_tables()
         self.time_ga = time_ga
         self.date_ga = date_ga
         self.instance = instance
@@ -58,6 +67,132 @@ class KNX(lib.connection.Client):
         if readonly: 
             self.logger.warning("!!! KNX Plugin in READONLY mode !!! ")
         self.readonly = readonly
+        self._send_rate = float(send_rate)
+        self._send_queue_size = int(send_queue)
+        # one OrderedDict per priority: (ga, flag) -> (payload, dpt)
+        self._send_queue = [collections.OrderedDict() for prio in range(PRIO_STATUS + 1)]
+        self._send_cond = threading.Condition()
+        self.send_stats = {'depth': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+        self._init_window = int(init_window)
+        self._init_timeout = float(init_timeout)
+        self._init_retries = int(init_retries)
+        self.hydrate_stats = {'total': 0, 'cache': 0, 'bus': 0, 'failed': 0, 'duration': 0.0}
+        self._init_metrics()
+        self._snapshot_buffer = bytearray()
+        self._snapshot_appended = 0
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_file = None
+        if smarthome.string2bool(snapshot):
+            self._snapshot_file = '{0}/var/cache/knx_{1}.snapshot'.format(smarthome.base_dir, self.instance)
+            self._snapshot_read()
+            self._sh.scheduler.add('KNX[{0}] snapshot'.format(self.instance), self._snapshot_write, prio=5, cycle=10)
+
+    def _init_tables(self):
+        self.gal = {}
+        self.gar = {}
+        self._init_ga = []
+        self._cache_ga = []
+        # raw 16 bit destination -> (ga, dpt, decoder, items, logics), built at parse time
+        self._dispatch = {}
+        self._pa_names = {}
+        # raw destination -> ga of startup reads still waiting for a value
+        self._hydrate_pending = {}
+        self._hydrate_cond = threading.Condition()
+        # raw destination -> last payload of knx_init/knx_cache GAs, kept on disk to restore items at startup
+        self._snapshot = {}
+        self._snapshot_gas = set()
+
+    def _init_metrics(self):
+        self._telegrams = metrics.counter('knx_telegrams_total', 'KNX telegrams received', instance=self.instance)
+        metrics.gauge('knx_send_queue_depth', 'KNX group writes waiting in the send queue', fn=lambda: self.send_stats['depth'], instance=self.instance)
+        for key in ('sent', 'coalesced', 'dropped', 'failed'):
+            metrics.counter('knx_send_{0}_total'.format(key), 'KNX group writes {0} by the send queue'.format(key), fn=lambda key=key: self.send_stats[key], instance=self.instance)
+        metrics.gauge('knx_init_pending', 'KNX init reads waiting for a value', fn=lambda: len(self._hydrate_pending), instance=self.instance)
+
+    def _ga_raw(self, ga):
+        return int.from_bytes(bytes(self.encode(ga, 'ga')), byteorder='big')
+
+    def _update_dispatch(self, ga):
+        try:
+            raw = self._ga_raw(ga)
+        except Exception:
+            self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.instance, ga))
+            return
+        entry = self.gal[ga]
+        self._dispatch[raw] = (ga, entry['dpt'], dpts.decode[str(entry['dpt'])], tuple(entry['items']), tuple(entry['logics']))
+
+    def _snapshot_record(self, raw, payload):
+        return struct.pack('>HB', raw, len(payload)) + payload
+
+    def _snapshot_read(self):
+        try:
+            with open(self._snapshot_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.warning('KNX[{0}]: problem reading snapshot {1}: {2}'.format(self.instance, self._snapshot_file, e))
+            return
+        pos = 0
+        while pos + 3 <= len(data):
+            raw, size = struct.unpack_from('>HB', data, pos)
+            pos += 3
+            if pos + size > len(data):  # truncated last record
+                break
+            self._snapshot[raw] = data[pos:pos + size]
+            pos += size
+            self._snapshot_appended += 1
+        self.logger.debug('KNX[{0}]: read {1} values from snapshot'.format(self.instance, len(self._snapshot)))
+
+    def _snapshot_restore(self, item, ga):
+        if self._snapshot_file is None:
+            return
+        try:
+            raw = self._ga_raw(ga)
+        except Exception:
+            return
+        self._snapshot_gas.add(raw)
+        if raw not in self._snapshot:
+            return
+        try:
+            val = self.decode(self._snapshot[raw], item.conf['knx_dpt'])
+        except Exception:
+            val = None
+        if val is not None:
+            item.set(val, 'KNX')
+
+    def _snapshot_update(self, raw, payload):
+        payload = bytes(payload)
+        if len(payload) > 0xff:
+            return
+        with self._snapshot_lock:
+            self._snapshot[raw] = payload
+            self._snapshot_buffer.extend(self._snapshot_record(raw, payload))
+            self._snapshot_appended += 1
+
+    def _snapshot_write(self):
+        if self._snapshot_file is None:
+            return
+        with self._snapshot_lock:
+            data = self._snapshot_buffer
+            self._snapshot_buffer = bytearray()
+            if not data:
+                return
+            compact = self._snapshot_appended > 4 * len(self._snapshot) + 100
+            if compact:
+                records = [self._snapshot_record(raw, payload) for raw, payload in self._snapshot.items() if raw in self._snapshot_gas]
+                data = b''.join(records)
+                self._snapshot_appended = len(records)
+        try:
+            if compact:
+                with open(self._snapshot_file + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(self._snapshot_file + '.tmp', self._snapshot_file)
+            else:
+                with open(self._snapshot_file, 'ab') as f:
+                    f.write(data)
+        except Exception as e:
+            self.logger.warning('KNX[{0}]: problem writing snapshot {1}: {2}'.format(self.instance, self._snapshot_file, e))
 
     def _send(self, data):
         if len(data) < 2 or len(data) > 0xffff:
@@ -74,7 +209,7 @@ class KNX(lib.connection.Client):
             pkt.extend(self.encode(ga, 'ga'))
         except:
             self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.instance, ga))
-            return
+            return False
         pkt.extend([0])
         pkt.extend(self.encode(payload, dpt))
         if flag == 'write':
@@ -83,15 +218,59 @@ class KNX(lib.connection.Client):
             flag = KNXRESP
         else:
             self.logger.warning("KNX[{0}]: groupwrite telegram for {1} with unknown flag: {2}. Please choose beetween write and response.".format(self.instance, ga, flag))
-            return
+            return False
         pkt[5] = flag | pkt[5]
         if self.readonly:
             self.logger.info("KNX: groupwrite telegram for: {0} - Value: {1} not send. Plugin in READONLY mode. ".format(ga,payload))
-        else:
-            self._send(pkt)
+            return False
+        return self._send(pkt) is not False
+
+    def _queue_write(self, ga, payload, dpt, flag='write', prio=PRIO_SEND):
+        if self._send_rate <= 0:
+            self.groupwrite(ga, payload, dpt, flag)
+            return
+        with self._send_cond:
+            queue = self._send_queue[prio]
+            if (ga, flag) in queue:
+                self.send_stats['coalesced'] += 1
+            elif self.send_stats['depth'] >= self._send_queue_size:
+                self.send_stats['dropped'] += 1
+                self.logger.warning("KNX[{0}]: send queue full, dropping {1} to {2}".format(self.instance, payload, ga))
+                return
+            else:
+                self.send_stats['depth'] += 1
+            queue[(ga, flag)] = (payload, dpt)
+            self._send_cond.notify()
+
+    def _send_worker(self):
+        interval = 1.0 / self._send_rate
+        next_send = 0
+        while self.alive:
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._send_cond:
+                while self.alive and self.send_stats['depth'] == 0:
+                    self._send_cond.wait(1)
+                if not self.alive:
+                    return
+                for queue in self._send_queue:
+                    if queue:
+                        (ga, flag), (payload, dpt) = queue.popitem(last=False)
+                        break
+                self.send_stats['depth'] -= 1
+            try:
+                if self.groupwrite(ga, payload, dpt, flag):
+                    self.send_stats['sent'] += 1
+                elif not self.readonly:
+                    self.send_stats['failed'] += 1
+            except Exception as e:
+                self.send_stats['failed'] += 1
+                self.logger.warning("KNX[{0}]: problem sending {1} to {2}: {3}".format(self.instance, payload, ga, e))
+            next_send = time.time() + interval
 
     def _cacheread(self, ga):
-        pkt = bytearray([0, 116])
+        pkt = bytearray([0, EIB_CACHE_READ_NOWAIT])
         try:
             pkt.extend(self.encode(ga, 'ga'))
         except:
@@ -125,22 +304,83 @@ class KNX(lib.connection.Client):
         enable_cache = bytearray([0, 112])
         self._send(enable_cache)
         self.found_terminator = self.parse_length
-        if self._cache_ga != []:
+        gas = []
+        if self._cache_ga != [] or self._init_ga != []:
             if self.connected:
+                gas = list(collections.OrderedDict.fromkeys(self._cache_ga + self._init_ga))
+                self._hydrate_start(gas)
                 self.logger.debug('KNX[{0}]: reading eibd cache'.format(self.instance))
-                for ga in self._cache_ga:
+                for ga in gas:
                     self._cacheread(ga)
                 self._cache_ga = []
+                self._init_ga = []
         self.logger.debug('KNX[{0}]: enable group monitor'.format(self.instance))
         init = bytearray([0, 38, 0, 0, 0])
         self._send(init)
         self.terminator = 2
-        if self._init_ga != []:
-            if self.connected:
-                self.logger.debug('KNX[{0}]: init read'.format(self.instance))
-                for ga in self._init_ga:
-                    self.groupread(ga)
-                self._init_ga = []
+        if gas != []:
+            hydrator = threading.Thread(target=self._hydrate, name='KNX[{0}] init'.format(self.instance))
+            hydrator.daemon = True
+            hydrator.start()
+
+    def _hydrate_start(self, gas):
+        pending = {}
+        for ga in gas:
+            try:
+                pending[self._ga_raw(ga)] = ga
+            except Exception:
+                self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.instance, ga))
+        with self._hydrate_cond:
+            self._hydrate_pending = pending
+        self.hydrate_stats = {'total': len(pending), 'cache': 0, 'bus': 0, 'failed': 0, 'duration': 0.0}
+        self._hydrate_begin = time.time()
+
+    def _hydrate(self):
+        # wait for the eibd cache, then read the misses from the bus with a window of outstanding reads
+        deadline = time.time() + self._init_timeout
+        with self._hydrate_cond:
+            while self._hydrate_pending and time.time() < deadline:
+                self._hydrate_cond.wait(deadline - time.time())
+            misses = collections.deque(self._hydrate_pending)
+        stats = self.hydrate_stats
+        stats['cache'] = stats['total'] - len(misses)
+        self.logger.debug('KNX[{0}]: {1} of {2} init values from eibd cache, reading {3} from the bus'.format(self.instance, stats['cache'], stats['total'], len(misses)))
+        outstanding = {}
+        attempts = {}
+        report = time.time() + 10
+        # the connection may come up before run(), so the reads only depend on the connection
+        while (misses or outstanding) and self.connected:
+            with self._hydrate_cond:
+                now = time.time()
+                if now > report:
+                    report = now + 10
+                    self.logger.info('KNX[{0}]: init running, {1} of {2} group addresses pending'.format(self.instance, len(self._hydrate_pending), stats['total']))
+                for raw in list(outstanding):
+                    if raw not in self._hydrate_pending:
+                        del outstanding[raw]
+                        stats['bus'] += 1
+                    elif outstanding[raw] < now:
+                        del outstanding[raw]
+                        if attempts[raw] <= self._init_retries:
+                            misses.append(raw)
+                        else:
+                            ga = self._hydrate_pending.pop(raw)
+                            stats['failed'] += 1
+                            self.logger.warning('KNX[{0}]: no reply for init read of {1}'.format(self.instance, ga))
+                while misses and len(outstanding) < self._init_window:
+                    raw = misses.popleft()
+                    if raw not in self._hydrate_pending:
+                        stats['bus'] += 1
+                        continue
+                    attempts[raw] = attempts.get(raw, 0) + 1
+                    outstanding[raw] = now + self._init_timeout
+                    self.groupread(self._hydrate_pending[raw])
+                if outstanding:
+                    self._hydrate_cond.wait(0.1)
+        with self._hydrate_cond:
+            self._hydrate_pending = {}
+        stats['duration'] = time.time() - self._hydrate_begin
+        self.logger.info('KNX[{0}]: init of {1} group addresses finished in {2:.1f}s: {3} from eibd cache, {4} from the bus, {5} without reply'.format(self.instance, stats['total'], stats['duration'], stats['cache'], stats['bus'], stats['failed']))
 
 #   def collect_incoming_data(self, data):
 #       print('#  bin   h  d')
@@ -165,71 +405,78 @@ class KNX(lib.connection.Client):
     def parse_telegram(self, data):
         self.found_terminator = self.parse_length  # reset parser and terminator
         self.terminator = 2
+        self._telegrams.value += 1
         # 2 byte type
         # 2 byte src
         # 2 byte dst
         # 2 byte command/data
         # x byte data
-        typ = struct.unpack(">H", data[0:2])[0]
-        if (typ != 39 and typ != 116) or len(data) < 8:
+        if len(data) < 8:
+            return
+        typ = data[0] << 8 | data[1]
+        if typ != 39 and typ != 116 and typ != EIB_CACHE_READ_NOWAIT:
 #           self.logger.debug("Ignore telegram.")
             return
         if (data[6] & 0x03 or (data[7] & 0xC0) == 0xC0):
             self.logger.debug("KNX[{0}]: Unknown APDU".format(self.instance))
             return
-        src = self.decode(data[2:4], 'pa')
-        dst = self.decode(data[4:6], 'ga')
+        raw = data[2] << 8 | data[3]
+        src = self._pa_names.get(raw)
+        if src is None:
+            src = self._pa_names[raw] = self.decode(data[2:4], 'pa')
         flg = data[7] & 0xC0
-        if flg == KNXWRITE:
-            flg = 'write'
-        elif flg == KNXREAD:
-            flg = 'read'
-        elif flg == KNXRESP:
-            flg = 'response'
-        else:
-            self.logger.warning("KNX[{0}]: Unknown flag: {1:02x} src: {2} dest: {3}".format(self.instance, flg, src, dst))
-            return
         if len(data) == 8:
             payload = bytearray([data[7] & 0x3f])
         else:
             payload = data[8:]
-        if flg == 'write' or flg == 'response':
-            if dst not in self.gal:  # update item/logic
-                self._busmonitor("KNX[{0}]: {1} set {2} to {3}".format(self.instance, src, dst, binascii.hexlify(payload).decode()))
+        if flg == KNXWRITE or flg == KNXRESP:
+            raw = data[4] << 8 | data[5]
+            dispatch = self._dispatch.get(raw)
+            if dispatch is None:  # update item/logic
+                self._busmonitor("KNX[{0}]: {1} set {2} to {3}".format(self.instance, src, self.decode(data[4:6], 'ga'), binascii.hexlify(payload).decode()))
                 return
-            dpt = self.gal[dst]['dpt']
+            if self._hydrate_pending:
+                with self._hydrate_cond:
+                    if self._hydrate_pending.pop(raw, None) is not None:
+                        self._hydrate_cond.notify()
+            dst, dpt, decoder, items, logics = dispatch
             try:
-                val = self.decode(payload, dpt)
+                val = decoder(payload)
             except Exception as e:
                 self.logger.exception("KNX[{0}]: Problem decoding frame from {1} to {2} with '{3}' and DPT {4}. Exception: {5}".format(self.instance, src, dst, binascii.hexlify(payload).decode(), dpt, e))
                 return
             if val is not None:
                 self._busmonitor("KNX[{0}]: {1} set {2} to {3}".format(self.instance, src, dst, val))
-                #print "in:  {0}".format(self.decode(payload, 'hex'))
-                #out = ''
-                #for i in self.encode(val, dpt):
-                #    out += " {0:x}".format(i)
-                #print "out:{0}".format(out)
-                for item in self.gal[dst]['items']:
+                if raw in self._snapshot_gas and self._snapshot.get(raw) != payload:
+                    self._snapshot_update(raw, payload)
+                for item in items:
                     item(val, 'KNX', src, dst)
-                for logic in self.gal[dst]['logics']:
+                for logic in logics:
                     logic.trigger('KNX', src, val, dst)
             else:
                 self.logger.warning("KNX[{0}]: Wrong payload '{3}' for ga '{2}' with dpt '{1}'.".format(self.instance, dpt, dst, binascii.hexlify(payload).decode()))
-        elif flg == 'read':
+        elif flg == KNXREAD:
+            dst = self.decode(data[4:6], 'ga')
             self.logger.debug("KNX[{0}]: {1} read {2}".format(self.instance, src, dst))
             if dst in self.gar:  # read item
                 if self.gar[dst]['item'] is not None:
                     item = self.gar[dst]['item']
-                    self.groupwrite(dst, item(), item.conf['knx_dpt'], 'response')
+                    self._queue_write(dst, item(), item.conf['knx_dpt'], 'response', PRIO_RESPONSE)
                 if self.gar[dst]['logic'] is not None:
                     self.gar[dst]['logic'].trigger('KNX', src, None, dst)
 
     def run(self):
         self.alive = True
+        if self._send_rate > 0:
+            sender = threading.Thread(target=self._send_worker, name='KNX[{0}] send'.format(self.instance))
+            sender.daemon = True
+            sender.start()
 
     def stop(self):
         self.alive = False
+        with self._send_cond:
+            self._send_cond.notify_all()
+        self._snapshot_write()
         self.handle_close()
 
     def parse_item(self, item):
@@ -263,6 +510,7 @@ class KNX(lib.connection.Client):
                 else:
                     if not item in self.gal[ga]['items']:
                         self.gal[ga]['items'].append(item)
+                self._update_dispatch(ga)
 
         if 'knx_init' in item.conf:
             ga = item.conf['knx_init']
@@ -272,6 +520,8 @@ class KNX(lib.connection.Client):
             else:
                 if not item in self.gal[ga]['items']:
                     self.gal[ga]['items'].append(item)
+            self._update_dispatch(ga)
+            self._snapshot_restore(item, ga)
             self._init_ga.append(ga)
 
         if 'knx_cache' in item.conf:
@@ -282,6 +532,8 @@ class KNX(lib.connection.Client):
             else:
                 if not item in self.gal[ga]['items']:
                     self.gal[ga]['items'].append(item)
+            self._update_dispatch(ga)
+            self._snapshot_restore(item, ga)
             self._cache_ga.append(ga)
 
         if 'knx_reply' in item.conf:
@@ -335,6 +587,7 @@ class KNX(lib.connection.Client):
                     self.gal[ga] = {'dpt': dpt, 'items': [], 'logics': [logic]}
                 else:
                     self.gal[ga]['logics'].append(logic)
+                self._update_dispatch(ga)
 
         if 'knx_reply' in logic.conf:
             knx_reply = logic.conf['knx_reply']
@@ -355,8 +608,8 @@ class KNX(lib.connection.Client):
         if 'knx_send' in item.conf:
             if caller != 'KNX':
                 for ga in item.conf['knx_send']:
-                    self.groupwrite(ga, item(), item.conf['knx_dpt'])
+                    self._queue_write(ga, item(), item.conf['knx_dpt'])
         if 'knx_status' in item.conf:
             for ga in item.conf['knx_status']:  # send status update
                 if ga != dest:
-                    self.groupwrite(ga, item(), item.conf['knx_dpt'])
+                    self._queue_write(ga, item(), item.conf['knx_dpt'], prio=PRIO_STATUS)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.py.
+#  Visit:  https://github.com/smarthomeNG/
+#
+#  SmartHomeNG.py is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG.py is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.py. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+#
+# Replays recorded eibd/knxd frames through KNX.parse_telegram.
+#
+# Run from the SmartHomeNG base directory:
+#   python3 -m plugins.knx.benchmark frames.txt [repeat]
+#
+# Every line of frames.txt holds one telegram as hex (without the two
+# length bytes), optionally followed by the dpt of the destination GA:
+#   0027110109030081 1
+# Destinations with a dpt are mapped to a counting dummy item.
+
+import logging
+import sys
+import time
+
+from plugins.knx import KNX
+
+
+class _Item:
+
+    def __init__(self, ga):
+        self.ga = ga
+        self.updates = 0
+
+    def __call__(self, value, caller=None, source=None, dest=None):
+        self.updates += 1
+
+    def __str__(self):
+        return self.ga
+
+
+def load(filename):
+    frames = []
+    dpts = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            frame = bytearray.fromhex(line[0])
+            frames.append(frame)
+            if len(line) > 1 and len(frame) >= 6:
+                dpts[frame[4] << 8 | frame[5]] = line[1]
+    return frames, dpts
+
+
+def replay(frames, dpts, repeat=1):
+    knx = KNX.__new__(KNX)
+    knx.logger = logging.getLogger('knx.benchmark')
+    knx.instance = 'benchmark'
+    knx.readonly = True
+    knx._busmonitor = knx.logger.debug
+    knx._init_tables()
+    knx.send_stats = {'depth': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+    knx._init_metrics()
+    items = []
+    for raw, dpt in dpts.items():
+        ga = knx.decode(raw.to_bytes(2, byteorder='big'), 'ga')
+        item = _Item(ga)
+        items.append(item)
+        knx.gal[ga] = {'dpt': dpt, 'items': [item], 'logics': []}
+        knx._update_dispatch(ga)
+    start = time.perf_counter()
+    for i in range(repeat):
+        for frame in frames:
+            knx.parse_telegram(frame)
+    duration = time.perf_counter() - start
+    return duration, sum(item.updates for item in items)
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: python3 -m plugins.knx.benchmark frames.txt [repeat]")
+        return 1
+    repeat = int(argv[2]) if len(argv) > 2 else 100
+    frames, dpts = load(argv[1])
+    duration, updates = replay(frames, dpts, repeat)
+    count = len(frames) * repeat
+    print("{0} telegrams in {1:.3f}s: {2:.0f} telegrams/s, {3:.1f} us/telegram, {4} item updates".format(count, duration, count / duration, duration / count * 1e6, updates))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
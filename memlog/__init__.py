@@ -22,29 +22,91 @@
 import logging
 import threading
 import datetime
+import itertools
 import time
 import lib.log
 
 
 
+class _Log(lib.log.Log):
+    """
+    lib.log.Log keeps the newest maxlen entries in a deque, which is a fixed size ring buffer.
+    Every entry gets a sequence number, so clients can ask for the entries they have not seen yet.
+    """
+
+    def __init__(self, smarthome, name, mapping, maxlen):
+        self.seq = 0
+        self._seq_lock = threading.Lock()
+        lib.log.Log.__init__(self, smarthome, name, mapping, maxlen)
+
+    def add(self, entry):
+        # the listeners of the 'log' event (as in lib.log.Log.add) are called without the lock,
+        # so loggers don't wait for slow clients and listeners may call export_since
+        with self._seq_lock:
+            self.seq += 1
+            self.appendleft(entry)
+        for listener in self._sh.return_event_listeners('log'):
+            listener('log', {'name': self._name, 'log': [dict(zip(self.mapping, entry))]})
+
+    def export_since(self, seq, number=None):
+        """
+        Returns the entries added after seq, newest first, and the sequence number of the newest
+        entry returned. If more than number entries are unseen the oldest of them are returned,
+        so the client continues with the returned sequence number. Without seq the newest entries
+        and the current sequence number are returned.
+        """
+        with self._seq_lock:
+            if seq is None:
+                count = len(self)
+            else:
+                count = min(max(self.seq - seq, 0), len(self))
+            skip = 0
+            if number is not None and count > number:
+                if seq is not None:
+                    skip = count - number
+                count = number
+            entries = [dict(zip(self.mapping, entry)) for entry in itertools.islice(self, skip, skip + count)]
+            return self.seq - skip, entries
+
+
 class MemLog():
     _log = None
     _items = {}
 
+    # kinds of the mapping fields, everything else is taken from the logged values
+    _TIME = 0
+    _THREAD = 1
+    _LEVEL = 2
+    _VALUE = 3
+
     def __init__(self, smarthome, name, mapping = ['time', 'thread', 'level', 'message'], items = [], maxlen = 50):
         logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.name = name
-        self._log = lib.log.Log(smarthome, name, mapping, maxlen)
+        if type(mapping) is str:
+            mapping = [mapping]
+        self._log = _Log(smarthome, name, mapping, int(maxlen))
+        kinds = {'time': self._TIME, 'thread': self._THREAD, 'level': self._LEVEL}
+        self._fields = [kinds.get(name, self._VALUE) for name in mapping]
+        if type(items) is str:
+            items = [items]
         self._items = items
+        # the configured items, resolved in parse_item
+        self._item_objects = [None] * len(items)
 
     def run(self):
         self.alive = True
+        for path, item in zip(self._items, self._item_objects):
+            if item is None:
+                logging.getLogger(__name__).warning("MemLog {}: unknown item {}".format(self.name, path))
 
     def stop(self):
         self.alive = False
 
     def parse_item(self, item):
+        for index, path in enumerate(self._items):
+            if path == item.id():
+                self._item_objects[index] = item
         if 'memlog' in item.conf and item.conf['memlog'] == self.name:
             return self.update_item
         else:
@@ -67,25 +129,22 @@ class MemLog():
                 if len(self._items) == 0:
                     logvalues = [item()]
                 else:
-                    logvalues = []
-                    for item in self._items:
-                        logvalues.append(self._sh.return_item(item)())
+                    logvalues = [None if item is None else item() for item in self._item_objects]
 
                 self.log(logvalues, 'INFO')
 
     def log(self, logvalues, level = 'INFO'):
         if len(logvalues):
-            log = []
-            for name in self._log.mapping:
-                if name == 'time':
-                    log.append(self._sh.now())
-                elif name == 'thread':
-                    log.append(threading.current_thread().name)
-                elif name == 'level':
-                    log.append(level)
+            values = iter(logvalues)
+            entry = []
+            for field in self._fields:
+                if field == self._VALUE:
+                    entry.append(next(values, None))
+                elif field == self._TIME:
+                    entry.append(self._sh.now())
+                elif field == self._THREAD:
+                    entry.append(threading.current_thread().name)
                 else:
-                    log.append(logvalues[0])
-                    logvalues = logvalues[1:]
-
-            self._log.add(log)
+                    entry.append(level)
 
+            self._log.add(tuple(entry))
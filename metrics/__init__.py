@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.py.
+#  Visit:  https://github.com/smarthomeNG/
+#
+#  SmartHomeNG.py is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG.py is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.py. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+#
+# Counters, gauges and histograms shared by the plugins.
+#
+# This is no plugin by itself, other plugins import it:
+#
+#   from plugins import metrics
+#   telegrams = metrics.counter('knx_telegrams_total', 'Telegrams received', instance='default')
+#   telegrams.inc()
+#
+# Updating a metric is a plain attribute update without locking, the values
+# are served by the backend plugin (/metrics in the Prometheus text format,
+# /metrics_json.html as json). Values that already exist elsewhere (queue
+# lengths, ...) are registered with a function instead, which is only called
+# when the metrics are read.
+
+import bisect
+import collections
+import logging
+import math
+import threading
+
+logger = logging.getLogger('')
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric():
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels, fn=None, label='key'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self.label = label
+        self.value = 0
+
+    def samples(self):
+        # yields (labels, value)
+        if self.fn is None:
+            yield self.labels, self.value
+            return
+        value = self.fn()
+        if isinstance(value, dict):
+            for key, value in value.items():
+                labels = dict(self.labels)
+                labels[self.label] = str(key)
+                yield labels, value
+        else:
+            yield self.labels, value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1):
+        self.value += value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        counts = list(self.counts)
+        cumulative = []
+        total = 0
+        for count in counts:
+            total += count
+            cumulative.append(total)
+        yield self.labels, {'buckets': collections.OrderedDict(zip(self.buckets + (math.inf,), cumulative)), 'sum': self.sum, 'count': total}
+
+
+class Registry():
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, labels, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError("metric {0} is already registered as {1}".format(name, metric.kind))
+            elif kwargs.get('fn') is not None:
+                metric.fn = kwargs['fn']  # a restarted plugin replaces the function of the old instance
+            return metric
+
+    def counter(self, name, help='', fn=None, label='key', **labels):
+        """
+        Returns the counter name with the given labels, registering it if needed.
+        fn returns the value (or a dict label value -> value) if given.
+        """
+        return self._get(Counter, name, help, labels, fn=fn, label=label)
+
+    def gauge(self, name, help='', fn=None, label='key', **labels):
+        """
+        Returns the gauge name with the given labels, registering it if needed.
+        fn returns the value (or a dict label value -> value) if given.
+        """
+        return self._get(Gauge, name, help, labels, fn=fn, label=label)
+
+    def histogram(self, name, help='', buckets=BUCKETS, **labels):
+        """
+        Returns the histogram name with the given labels, registering it if needed.
+        """
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def remove(self, name, **labels):
+        with self._lock:
+            self._metrics.pop((name, tuple(sorted(labels.items()))), None)
+
+    def collect(self):
+        """
+        Returns name -> (kind, help, [(labels, value), ...]) of all metrics
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = collections.OrderedDict()
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.warning("Metrics: problem reading {0}: {1}".format(metric.name, e))
+                continue
+            if metric.name not in result:
+                result[metric.name] = (metric.kind, metric.help, [])
+            result[metric.name][2].extend(samples)
+        return result
+
+    def export(self):
+        """
+        Returns all metrics as a dict suitable for json
+        """
+        result = collections.OrderedDict()
+        for name, (kind, help, samples) in self.collect().items():
+            values = []
+            for labels, value in samples:
+                if kind == 'histogram':
+                    value = dict(value, buckets=collections.OrderedDict((_number(bound), count) for bound, count in value['buckets'].items()))
+                values.append({'labels': labels, 'value': value})
+            result[name] = {'type': kind, 'help': help, 'samples': values}
+        return result
+
+    def prometheus(self):
+        """
+        Returns all metrics in the Prometheus text format
+        """
+        lines = []
+        for name, (kind, help, samples) in self.collect().items():
+            if help:
+                lines.append('# HELP {0} {1}'.format(name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in samples:
+                if kind == 'histogram':
+                    for bound, count in value['buckets'].items():
+                        lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le=_number(bound)), count))
+                    lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), _number(value['sum'])))
+                    lines.append('{0}_count{1} {2}'.format(name, _labels(labels), value['count']))
+                else:
+                    lines.append('{0}{1} {2}'.format(name, _labels(labels), _number(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _number(value):
+    if value is None:  # a gauge not set yet
+        return 'NaN'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in sorted(labels.items())) + '}'
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+remove = registry.remove
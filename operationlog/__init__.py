@@ -57,6 +57,10 @@ class OperationLog(AbLogger):
         self._path = name
         self._cachefile = None
         self._cache = True
+        # new entries are appended to the cache file, which is compacted every maxlen entries
+        self._cachehandle = None
+        self._cache_lock = threading.RLock()
+        self._journaled = 0
         self.__myLogger = None
         self._logcache = None
         self._maxlen = maxlen
@@ -90,6 +94,7 @@ class OperationLog(AbLogger):
                     logger.info("OperationLog {}: generated cache file".format(self.name))
                 except Exception as e:
                     logger.warning("OperationLog {}: problem reading cache: {}".format(self._path, e))
+            self._cache_compact()
 
     def update_logfilename(self):
         if self.__date == datetime.datetime.today() and self.__fname is not None:
@@ -105,6 +110,12 @@ class OperationLog(AbLogger):
 
     def stop(self):
         self.alive = False
+        if self._cache is True:
+            self._cache_compact()
+            with self._cache_lock:
+                if self._cachehandle is not None:
+                    self._cachehandle.close()
+                    self._cachehandle = None
 
     def parse_item(self, item):
         if 'olog' in item.conf and item.conf['olog'] == self.name:
@@ -125,11 +136,32 @@ class OperationLog(AbLogger):
         elif isinstance(param1, type(None)) and isinstance(param2, type(None)):
             return self._log
 
-        if self._cache is True:
+    def _cache_append(self, entry):
+        with self._cache_lock:
+            if self._cachehandle is None:
+                return
             try:
-                _cache_write(self._cachefile, self._log.export(self._maxlen))
+                pickle.dump(dict(zip(self._log.mapping, entry)), self._cachehandle)
+                self._cachehandle.flush()
+                self._journaled += 1
             except Exception as e:
                 logger.warning("OperationLog {}: could not update cache {}".format(self._path, e))
+                return
+            if self._journaled >= int(self._maxlen):
+                self._cache_compact()
+
+    def _cache_compact(self):
+        # replace the journal by the entries kept in memory
+        with self._cache_lock:
+            if self._cachehandle is not None:
+                self._cachehandle.close()
+                self._cachehandle = None
+            try:
+                _cache_write(self._cachefile, self._log.export(int(self._maxlen)))
+                self._cachehandle = open(self._cachefile, 'ab')
+            except Exception as e:
+                logger.warning("OperationLog {}: could not update cache {}".format(self._path, e))
+            self._journaled = 0
 
     def load(self, logentries):
         if len(logentries) != 0:
@@ -171,6 +203,8 @@ class OperationLog(AbLogger):
                     values_txt = map(str, logvalues)
                     log.append(' '.join(values_txt))
             self._log.add(log)
+            if self._cache is True:
+                self._cache_append(log)
             if self._logtofile is True:
                 self.update_logfilename()
                 self.__myLogger.info('{}: {}', log[2], ''.join(log[3:]))
@@ -180,17 +214,29 @@ class OperationLog(AbLogger):
 # Cache Methods
 #####################################################################
 def _cache_read(filename, tz):
+    # the file starts with a list of entries (newest first), followed by a journal of single entries
     ts = os.path.getmtime(filename)
     dt = datetime.datetime.fromtimestamp(ts, tz)
     value = None
     with open(filename, 'rb') as f:
         value = pickle.load(f)
+        while True:
+            try:
+                entry = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                logger.warning("Skipping incomplete journal entry at the end of {}".format(filename))
+                break
+            value.insert(0, entry)
     return (dt, value)
 
 
 def _cache_write(filename, value):
+    # write a new file and replace the old one, so a crash leaves either of them
     try:
-        with open(filename, 'wb') as f:
+        with open(filename + '.tmp', 'wb') as f:
             pickle.dump(value, f)
+        os.replace(filename + '.tmp', filename)
     except IOError:
         logger.warning("Could not write to {}".format(filename))
@@ -19,10 +19,14 @@
 #  along with SmartHome.py.  If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import collections
+import concurrent.futures
 import datetime
 import functools
 import logging
 import os
+import threading
+import time
 
 import rrdtool
 
@@ -31,13 +35,34 @@ logger = logging.getLogger('')
 
 class RRD():
 
-    def __init__(self, smarthome, step=300, rrd_dir=None):
+    def __init__(self, smarthome, step=300, rrd_dir=None, write_back=0, rrdcached=None, fetch_threads=4, fetch_cache=100):
         self._sh = smarthome
         if rrd_dir is None:
             rrd_dir = smarthome.base_dir + '/var/rrd/'
         self._rrd_dir = rrd_dir
         self._rrds = {}
         self.step = int(step)
+        # samples waiting to be written: itempath -> ['timestamp:value', ...]
+        self._write_back = int(write_back)
+        self._buffer = {}
+        self._buffer_lock = threading.Lock()
+        # held while buffered samples are written, a fetch waits for them
+        self._flush_lock = threading.Lock()
+        if rrdcached:
+            self._daemon = ['--daemon', rrdcached]
+        else:
+            self._daemon = []
+        # fetches run on a bounded pool, results are kept until the next update cycle
+        self._fetch_threads = int(fetch_threads)
+        self._pool = None
+        if self._fetch_threads > 0:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._fetch_threads)
+        self._cache = collections.OrderedDict()
+        self._cache_size = int(fetch_cache)
+        self._cache_epoch = 0
+        self._file_epochs = {}  # rrd file -> epoch, bumped when buffered samples of the file are written
+        self._cache_lock = threading.Lock()
+        self._init = []
 
     def run(self):
         self.alive = True
@@ -46,27 +71,135 @@ class RRD():
             rrd = self._rrds[itempath]
             if not os.path.isfile(rrd['rrdb']):
                 self._create(rrd)
+        self._init_items()
         offset = 100  # wait 100 seconds for 1-Wire to update values
         self._sh.scheduler.add('RRDtool', self._update_cycle, cycle=self.step, offset=offset, prio=5)
+        if self._write_back > 0:
+            self._sh.scheduler.add('RRDtool flush', self._flush, cycle=self._write_back, offset=offset + self._write_back, prio=5)
 
     def stop(self):
         self.alive = False
+        self._flush()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
 
     def _update_cycle(self):
+        now = int(time.time())
         for itempath in self._rrds:
             rrd = self._rrds[itempath]
             if rrd['type'] == 'GAUGE':
-                value = 'N:' + str(float(rrd['item']()))
+                value = str(float(rrd['item']()))
             else:  # 'COUNTER'
-                value = 'N:' + str(int(rrd['step'] * rrd['item']()))
+                value = str(int(rrd['step'] * rrd['item']()))
+            if self._write_back > 0:
+                with self._buffer_lock:
+                    self._buffer.setdefault(itempath, []).append('{}:{}'.format(now, value))
+                continue
+            self._update(itempath, ['N:' + value])
+        self._cache_clear()
+
+    def _update(self, itempath, samples):
+        rrdb = self._rrds[itempath]['rrdb']
+        try:
+            rrdtool.update(rrdb, *(self._daemon + samples))
+        except Exception as e:
+            if len(samples) == 1:
+                logger.warning("RRD: error updating {}: {}".format(itempath, e))
+                return
+            # one rejected sample (e.g. not newer than the last update after a clock step)
+            # fails the whole batch, so the samples are written one by one
+            discarded = 0
+            for sample in samples:
+                try:
+                    rrdtool.update(rrdb, *(self._daemon + [sample]))
+                except Exception:
+                    discarded += 1
+            logger.warning("RRD: error updating {}: {}, discarded {} of {} buffered samples".format(itempath, e, discarded, len(samples)))
+
+    def _flush(self, itempath=None):
+        # write buffered samples with one update per rrd file
+        flush_all = itempath is None
+        with self._flush_lock:
+            with self._buffer_lock:
+                if itempath is None:
+                    buffer = self._buffer
+                    self._buffer = {}
+                elif itempath in self._buffer:
+                    buffer = {itempath: self._buffer.pop(itempath)}
+                else:
+                    return
+            for itempath, samples in buffer.items():
+                self._update(itempath, samples)
+            # results fetched before the samples were written must not be served any longer
+            if flush_all:
+                self._cache_clear()
+            else:
+                self._cache_clear(self._rrds[itempath]['rrdb'])
+
+    def _fetch(self, itempath, query):
+        return self._fetch_future(itempath, query).result()
+
+    def _fetch_future(self, itempath, query):
+        # returns a future of the fetch, which runs on the fetch pool unless it is cached
+        # buffered samples belong into the answer, also those of a flush already running
+        if self._write_back > 0:
+            self._flush(itempath)
+        query = query + self._daemon
+        key = tuple(query)  # file, consolidation function, start, end and resolution
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                future = concurrent.futures.Future()
+                future.set_result(self._cache[key])
+                return future
+            epoch = (self._cache_epoch, self._file_epochs.get(key[0], 0))
+        if self._pool is not None:
+            return self._pool.submit(self._fetch_query, query, key, epoch)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self._fetch_query(query, key, epoch))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _fetch_query(self, query, key, epoch):
+        result = rrdtool.fetch(query)
+        with self._cache_lock:
+            if self._cache_size > 0 and epoch == (self._cache_epoch, self._file_epochs.get(key[0], 0)):
+                self._cache[key] = result
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def _cache_clear(self, rrdb=None):
+        # drops the results of one rrd file, or all of them if no file is given
+        with self._cache_lock:
+            if rrdb is None:
+                self._cache.clear()
+                self._file_epochs.clear()
+                self._cache_epoch += 1
+                return
+            for key in [key for key in self._cache if key[0] == rrdb]:
+                del self._cache[key]
+            self._file_epochs[rrdb] = self._file_epochs.get(rrdb, 0) + 1
+
+    def _init_items(self):
+        # read the last values of all 'rrd = init' items at once instead of one after the other
+        lasts = []
+        for item in self._init:
+            query = self._single_query('last', '5d', 'now', item.id())
+            if query is not None:
+                lasts.append((item, self._fetch_future(item.id(), query)))
+        for item, future in lasts:
             try:
-                rrdtool.update(
-                    rrd['rrdb'],
-                    value
-                )
+                meta, name, data = future.result()
             except Exception as e:
-                logger.warning("RRD: error updating {}: {}".format(itempath, e))
+                logger.warning("error reading {0} data: {1}".format(item.id(), e))
                 continue
+            last = self._single_value('last', data)
+            if last is not None:
+                item.set(last, 'RRDtool')
+        self._init = []
 
     def parse_item(self, item):
         if 'rrd' not in item.conf:
@@ -90,9 +223,7 @@ class RRD():
         self._rrds[item.id()] = {'item': item, 'id': item.id(), 'rrdb': rrdb, 'max': rrd_max, 'min': rrd_min, 'step': rrd_step, 'type': rrd_type}
 
         if item.conf['rrd'] == 'init':
-            last = self._single('last', '5d', item=item.id())
-            if last is not None:
-                item.set(last, 'RRDtool')
+            self._init.append(item)
 
     def parse_logic(self, logic):
         pass
@@ -131,7 +262,7 @@ class RRD():
         if step is not None:
             query.extend(['--resolution', step])
         try:
-            meta, name, data = rrdtool.fetch(query)
+            meta, name, data = self._fetch(item, query)
         except Exception as e:
             logger.warning("error reading {0} data: {1}".format(item, e))
             return None
@@ -148,6 +279,17 @@ class RRD():
         return reply
 
     def _single(self, func, start='1d', end='now', item=None):
+        query = self._single_query(func, start, end, item)
+        if query is None:
+            return
+        try:
+            meta, name, data = self._fetch(item, query)
+        except Exception as e:
+            logger.warning("error reading {0} data: {1}".format(item, e))
+            return None
+        return self._single_value(func, data)
+
+    def _single_query(self, func, start, end, item):
         if item in self._rrds:
             rrd = self._rrds[item]
         else:
@@ -180,11 +322,9 @@ class RRD():
                 query.extend(['--end', "{}".format(end)])
             else:
                 query.extend(['--end', "now-{}".format(end)])
-        try:
-            meta, name, data = rrdtool.fetch(query)
-        except Exception as e:
-            logger.warning("error reading {0} data: {1}".format(item, e))
-            return None
+        return query
+
+    def _single_value(self, func, data):
         values = [v[0] for v in data if v[0] is not None]
         if func == 'avg':
             if len(values) > 0:
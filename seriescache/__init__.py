@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+# Copyright 2013 Marcus Popp                               marcus@popp.mx
+#########################################################################
+#  This file is part of SmartHome.py.    http://mknx.github.io/smarthome/
+#
+#  SmartHome.py is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHome.py is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHome.py. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+#
+# Series result cache shared by the sqlite and sqlite_visu2_8 plugins.
+#
+# This is no plugin by itself, the plugins import it:
+#
+#   from plugins.seriescache import SeriesCache
+
+import collections
+import math
+import threading
+
+
+class SeriesCache():
+    """
+    Grouped rows of the series queries, kept per (item, func, start, end, step).
+
+    A later query of the same series only fetches the buckets written since, the
+    size limits the number of buckets kept over all series.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._points = 0
+        self._epoch = 0
+        self._seq = {}
+
+    def get(self, key, fetch, lower, iend, step):
+        # key: (item, func, start, end, step); fetch(lo, hi) returns the grouped rows
+        # between lo (None for the whole window) and hi
+        item = key[0]
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            seq = (self._epoch, self._seq.get(item, 0))
+        lead = int(lower // step)
+        ranges = [(None, iend)]
+        buckets = {}
+        if entry is not None and lower >= entry['lower'] and iend >= entry['iend']:
+            tail = int(entry['iend'] // step)
+            if entry['dirty'] is not None:
+                tail = min(tail, int(entry['dirty'] // step))
+            if entry['dirty'] is None and key[3] == 'now':
+                # rows newer than 'now' can only show up with a later write, which marks the entry dirty
+                ranges = []
+                tail = int(iend // step) + 1
+            else:
+                ranges = [(math.ceil(tail * step), iend)]
+            if lower == entry['lower']:
+                buckets = {b: t for b, t in entry['buckets'].items() if b < tail}
+            elif tail > lead + 1:
+                ranges.insert(0, (None, math.ceil((lead + 1) * step) - 1))
+                buckets = {b: t for b, t in entry['buckets'].items() if lead < b < tail}
+            else:
+                ranges = [(None, iend)]
+        for lo, hi in ranges:
+            tuples = fetch(lo, hi)
+            if tuples is None:
+                return
+            buckets.update((int(t[0] // step), t) for t in tuples)
+        with self._lock:
+            if seq == (self._epoch, self._seq.get(item, 0)):
+                old = self._cache.pop(key, None)
+                if old is not None:
+                    self._points -= len(old['buckets'])
+                self._cache[key] = {'lower': lower, 'iend': iend, 'dirty': None, 'buckets': buckets}
+                self._points += len(buckets)
+                while self._points > self.size:
+                    key, old = self._cache.popitem(last=False)
+                    self._points -= len(old['buckets'])
+        return sorted(buckets.values())
+
+    def changed(self, changes):
+        # changes: {item: oldest time written}
+        with self._lock:
+            for item in changes:
+                self._seq[item] = self._seq.get(item, 0) + 1
+            for key, entry in self._cache.items():
+                if key[0] in changes:
+                    if entry['dirty'] is None or changes[key[0]] < entry['dirty']:
+                        entry['dirty'] = changes[key[0]]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._cache.clear()
+            self._points = 0
@@ -23,43 +23,50 @@ import logging
 import sqlite3
 import datetime
 import functools
+import itertools
 import time
 import threading
+import queue
+import urllib.request
+import zlib
 from lib.model.smartplugin import SmartPlugin
+from plugins.seriescache import SeriesCache
+from plugins import metrics
 
 
 class SQL(SmartPlugin):
 
     ALLOW_MULTIINSTANCE = False
     PLUGIN_VERSION = "1.1.1"
-    _version = 2
+    _version = 3
     # (period days, granularity hours)
     periods = [(1900, 168), (400, 24), (32, 1), (7, 0.5), (1, 0.1)]
     # SQL queries
     # time, item, avg, vmin, vmax, power
     _create_db = "CREATE TABLE IF NOT EXISTS history (time INTEGER, item TEXT, avg REAL, vmin REAL, vmax REAL, power REAL);"
-    _create_index = "CREATE INDEX IF NOT EXISTS idy ON history (item);"
-    _pack_query = """
-        SELECT
-        group_concat(rowid),
-        group_concat(time),
-        group_concat(avg),
-        group_concat(power),
-        item,
-        MIN(vmin),
-        MAX(vmax)
-        FROM history
-        WHERE (time < {})
-        GROUP by CAST((time / {}) AS INTEGER), item
-        ORDER BY time DESC;"""
+    _create_index = "CREATE INDEX IF NOT EXISTS idy_time ON history (item, time);"
+    _last_query = "SELECT avg from history WHERE item = ? ORDER BY time DESC LIMIT 1"
+    _prev_query = "SELECT time from history WHERE item = ? AND time <= ? ORDER BY time DESC LIMIT 1"
+    _create_pack = "CREATE TABLE IF NOT EXISTS pack (period INTEGER PRIMARY KEY, time INTEGER);"
+    _pack_items_query = "SELECT DISTINCT item FROM history WHERE time >= ? AND time < ?;"
+    _pack_rows_query = "SELECT time, avg, vmin, vmax, power FROM history WHERE item = ? AND time >= ? AND time < ? ORDER BY time DESC;"
+    _next_query = "SELECT MIN(time) FROM history WHERE item = ? AND time >= ?;"
+    # seconds the pack may hold the lock before giving way to other writers
+    _pack_chunk_time = 0.5
+    _vacuum_pages = 1000
+    _journal_modes = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+    _synchronous_modes = ['off', 'normal', 'full', 'extra']
 
-    def __init__(self, smarthome, cycle=300, path=None):
+    def __init__(self, smarthome, cycle=300, path=None, journal_mode='wal', synchronous='normal', read_pool=4, series_cache=100000):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.connected = False
         self._dump_cycle = int(cycle)
         self._buffer = {}
         self._buffer_lock = threading.Lock()
+        self._readers = None
+        self._read_pool = int(read_pool)
+        self._series_cache = SeriesCache(int(series_cache))
 #       sqlite3.register_adapter(datetime.datetime, self._timestamp)
         self.logger.debug("SQLite {0}".format(sqlite3.sqlite_version))
         self._fdb_lock = threading.Lock()
@@ -75,6 +82,11 @@ class SQL(SmartPlugin):
             self._fdb_lock.release()
             return
         self.connected = True
+        self._set_profile(journal_mode, synchronous)
+        self.flush_stats = {'rows': 0, 'duration': 0.0, 'last': None}
+        self._flush_seconds = metrics.histogram('sqlite_flush_seconds', 'Duration of the SQLite dumps')
+        self._flush_rows = metrics.counter('sqlite_flush_rows_total', 'Rows written by the SQLite dumps')
+        metrics.gauge('sqlite_buffered_items', 'Items with values waiting for the next SQLite dump', fn=lambda: sum(1 for tuples in list(self._buffer.values()) if tuples))
         integrity = self._fdb.execute("PRAGMA integrity_check(10);").fetchone()[0]
         if integrity == 'ok':
             self.logger.debug("SQLite: database integrity ok")
@@ -82,6 +94,10 @@ class SQL(SmartPlugin):
             self.logger.error("SQLite: database corrupt. Seek help.")
             self._fdb_lock.release()
             return
+        if self._fdb.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            self.logger.info("SQLite: enabling incremental vacuum. Please wait!")
+            self._fdb.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            self._fdb.execute("VACUUM;")
         common = self._fdb.execute("SELECT * FROM sqlite_master WHERE name='common' and type='table';").fetchone()
         if common is None:
             self._fdb.execute("CREATE TABLE common (version INTEGER);")
@@ -94,12 +110,18 @@ class SQL(SmartPlugin):
                 self._fdb.execute("DROP TABLE history;")
         self._fdb.execute("DROP INDEX IF EXISTS idx;")
         self._fdb.execute(self._create_db)
+        if version < 3:
+            self.logger.info("SQLite: replacing item index with (item, time) index. Please wait!")
+            self._fdb.execute("DROP INDEX IF EXISTS idy;")
         self._fdb.execute(self._create_index)
+        self._fdb.execute(self._create_pack)
         if version < self._version:
             self._fdb.execute("UPDATE common SET version=:version;", {'version': self._version})
             # self.query("alter table history add column power INTEGER;")
         self._fdb.commit()
         self._fdb_lock.release()
+        if self._read_pool > 0:
+            self._open_readers()
         minute = 60 * 1000
         hour = 60 * minute
         day = 24 * hour
@@ -111,6 +133,35 @@ class SQL(SmartPlugin):
         smarthome.scheduler.add('SQLite pack', self._pack, cron='2 3 * *', prio=5)
         smarthome.scheduler.add('SQLite dump', self._dump, cycle=self._dump_cycle, offset=20, prio=5)
 
+    def _set_profile(self, journal_mode, synchronous):
+        journal_mode = str(journal_mode).lower()
+        if journal_mode in self._journal_modes:
+            mode = self._fdb.execute("PRAGMA journal_mode={};".format(journal_mode)).fetchone()[0]
+            self.logger.debug("SQLite: journal mode {}".format(mode))
+        else:
+            self.logger.warning("SQLite: ignoring unknown journal_mode '{}'".format(journal_mode))
+        synchronous = str(synchronous).lower()
+        if synchronous in self._synchronous_modes:
+            self._fdb.execute("PRAGMA synchronous={};".format(synchronous))
+        else:
+            self.logger.warning("SQLite: ignoring unknown synchronous mode '{}'".format(synchronous))
+
+    def _open_readers(self):
+        if self._fdb.execute("PRAGMA journal_mode;").fetchone()[0] != 'wal':
+            self.logger.info("SQLite: read pool requires journal_mode wal, sharing the writer connection")
+            return
+        uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(self.path))
+        readers = queue.Queue()
+        try:
+            for i in range(self._read_pool):
+                readers.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+        except Exception as e:
+            self.logger.warning("SQLite: could not open read pool, sharing the writer connection: {}".format(e))
+            while not readers.empty():
+                readers.get().close()
+            return
+        self._readers = readers
+
     def parse_item(self, item):
         if 'history' in item.conf:  # XXX legacy history option remove sometime
             self.logger.warning("{} deprecated history attribute. Use sqlite as keyword instead.".format(item.id()))
@@ -119,7 +170,7 @@ class SQL(SmartPlugin):
             item.series = functools.partial(self._series, item=item.id())
             item.db = functools.partial(self._single, item=item.id())
             if item.conf['sqlite'] == 'init':
-                last = self._fetchone("SELECT avg from history WHERE item = '{0}' ORDER BY time DESC LIMIT 1".format(item.id()))
+                last = self._fetchone(self._last_query, (item.id(),))
                 if last is not None:
                     last = last[0]
                     item.set(last, 'SQLite')
@@ -143,6 +194,12 @@ class SQL(SmartPlugin):
         finally:
             self.connected = False
             self._fdb_lock.release()
+        if self._readers is not None:
+            for i in range(self._read_pool):
+                try:
+                    self._readers.get(timeout=2).close()
+                except Exception:
+                    pass
 
     def update_item(self, item, caller=None, source=None, dest=None):
         now = self._timestamp(self._sh.now())
@@ -165,7 +222,49 @@ class SQL(SmartPlugin):
         finally:
             self._fdb_lock.release()
             
+    def dump_stream(self, chunk=1 << 16):
+        """
+        Yields a gzip compressed sql dump of the database in chunks. The dump is read in one
+        transaction of a read only connection, which in journal_mode wal sees a snapshot and
+        does not block history writes. Returns None in other journal modes, there the dump
+        would lock out writers until the download is finished.
+        """
+        with self._fdb_lock:
+            mode = self._fdb.execute("PRAGMA journal_mode;").fetchone()[0]
+        if mode != 'wal':
+            self.logger.warning("SQLite: journal_mode is {}, not wal. The dump can not be streamed, it is written to a file while history writes wait".format(mode))
+            return None
+        return self._dump_stream(chunk)
+
+    def _dump_stream(self, chunk):
+        self.logger.info("SQLite: streaming dump of the database")
+        uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(self.path))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+        snapshot = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            snapshot.execute("BEGIN;")  # all reads of the dump see the same snapshot
+            lines = []
+            size = 0
+            for line in snapshot.iterdump():
+                lines.append(line)
+                size += len(line)
+                if size >= chunk:
+                    data = compressor.compress('\n'.join(lines + ['']).encode())
+                    lines = []
+                    size = 0
+                    if data:
+                        yield data
+            yield compressor.compress('\n'.join(lines + ['']).encode())
+            yield compressor.flush()
+        except Exception as e:
+            self.logger.warning("SQLite: Problem streaming dump: {0}".format(e))
+            raise
+        finally:
+            snapshot.close()
+
     def _dump(self):
+        inserts = []
+        changes = {}
         for item in self._buffer:
             self._buffer_lock.acquire()
             tuples = self._buffer[item]
@@ -174,19 +273,33 @@ class SQL(SmartPlugin):
             self.update_item(item)
             _now = self._timestamp(self._sh.now())
             try:
-                _insert = self.__dump(item.id(), tuples, _now)
+                insert = self.__dump(item.id(), tuples, _now)
             except:
                 continue
-            if not self._fdb_lock.acquire(timeout=10):
-                continue
-            try:
-                # time, item, avg, vmin, vmax, power
-                self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", _insert)
-                self._fdb.commit()
-            except Exception as e:
-                self.logger.warning("SQLite: problem updating {}: {}".format(item.id(), e))
-            finally:
-                self._fdb_lock.release()
+            inserts.append(insert)
+            changes[insert[1]] = insert[0]
+        if inserts == []:
+            return
+        if not self._fdb_lock.acquire(timeout=10):
+            self.logger.warning("SQLite: could not acquire lock, dropping {} rows".format(len(inserts)))
+            return
+        start = time.time()
+        try:
+            # time, item, avg, vmin, vmax, power
+            self._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", inserts)
+            self._fdb.commit()
+        except Exception as e:
+            self.logger.warning("SQLite: problem dumping {} rows: {}".format(len(inserts), e))
+            self._fdb.rollback()
+            return
+        finally:
+            self._fdb_lock.release()
+        duration = time.time() - start
+        self._series_cache.changed(changes)
+        self.flush_stats = {'rows': len(inserts), 'duration': duration, 'last': self._sh.now()}
+        self._flush_seconds.observe(duration)
+        self._flush_rows.inc(len(inserts))
+        self.logger.debug("SQLite: dumped {} rows in {:.3f}s".format(len(inserts), duration))
 
     def __dump(self, item, tuples, end):
         vsum = 0.0
@@ -227,7 +340,23 @@ class SQL(SmartPlugin):
             self.logger.warning("DB select: unkown time frame '{0}'".format(frame))
         return ts
 
+    def _read(self, fetch, *query):
+        try:
+            reader = self._readers.get(timeout=2)
+        except queue.Empty:
+            return
+        try:
+            if not self.connected:
+                return
+            return getattr(reader.execute(*query), fetch)()
+        except Exception as e:
+            self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
+        finally:
+            self._readers.put(reader)
+
     def _fetchone(self, *query):
+        if self._readers is not None:
+            return self._read('fetchone', *query)
         if not self._fdb_lock.acquire(timeout=2):
             return
         if not self.connected:
@@ -243,6 +372,8 @@ class SQL(SmartPlugin):
         return reply
 
     def _fetchall(self, *query):
+        if self._readers is not None:
+            return self._read('fetchall', *query)
         if not self._fdb_lock.acquire(timeout=2):
             return
         if not self.connected:
@@ -257,47 +388,109 @@ class SQL(SmartPlugin):
             self._fdb_lock.release()
         return reply
 
-    def _pack(self):
-        insert = []
-        delete = []
+    def _execute(self, *query):
         if not self._fdb_lock.acquire(timeout=2):
             return
         try:
-            self.logger.debug("SQLite: pack database")
-            for entry in self.periods:
-                now = self._timestamp(self._sh.now())
-                prev = {}
-                period, granularity = entry
-                period = int(now - period * 24 * 3600 * 1000)
-                granularity = int(granularity * 3600 * 1000)
-                for row in self._fdb.execute(self._pack_query.format(period, granularity)):
-                    gid, gtime, gavg, gpower, item, vmin, vmax = row
-                    gtime = gtime.split(',')
-                    if len(gtime) == 1:  # ignore
-                        prev[item] = gtime[0]
-                        continue
-                    if item not in prev:
-                        upper = now
-                    else:
-                        upper = prev[item]
-                    # pack !!!
-                    delete = gid
-                    gavg = gavg.split(',')
-                    gpower = gpower.split(',')
-                    _time, _avg, _power = self.__pack(gtime, gavg, gpower, upper)
-                    insert = (_time, item, _avg, vmin, vmax, _power)
-                    self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
-                    self._fdb.execute("DELETE FROM history WHERE rowid in ({0});".format(delete))
-                    self._fdb.commit()
-                    prev[item] = gtime[0]
-            self._fdb.execute("VACUUM;")
-            self._fdb.execute("PRAGMA shrink_memory;")
+            if not self.connected:
+                return
+            self._fdb.execute(*query)
+            self._fdb.commit()
         except Exception as e:
-            self.logger.exception("problem packing sqlite database: {} period: {} type: {}".format(e, period, type(period)))
-            self._fdb.rollback()
+            self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
         finally:
             self._fdb_lock.release()
 
+    def _pack(self):
+        self.logger.debug("SQLite: pack database")
+        for period, granularity in self.periods:
+            now = self._timestamp(self._sh.now())
+            cutoff = int(now - period * 24 * 3600 * 1000)
+            granularity = int(granularity * 3600 * 1000)
+            hwm = self._fetchone("SELECT time FROM pack WHERE period = ?;", (period,))
+            if hwm is None:
+                lower = 0
+            else:
+                lower = hwm[0] - hwm[0] % granularity  # repack the partial bucket at the high-water mark
+            items = self._fetchall(self._pack_items_query, (lower, cutoff))
+            if items is None:
+                self.logger.warning("SQLite: pack of period {} days skipped".format(period))
+                return
+            if not self._pack_period([item[0] for item in items], lower, cutoff, granularity, now):
+                self.logger.warning("SQLite: pack of period {} days interrupted".format(period))
+                return
+            self._execute("INSERT OR REPLACE INTO pack VALUES (?,?);", (period, cutoff))
+        self._vacuum()
+
+    def _pack_period(self, items, lower, cutoff, granularity, now):
+        while items:
+            if not self._fdb_lock.acquire(timeout=10):
+                return False
+            try:
+                if not self.connected:
+                    return False
+                chunk_end = time.time() + self._pack_chunk_time
+                changes = {}
+                while items and time.time() < chunk_end:
+                    item = items.pop()
+                    oldest = self._pack_item(item, lower, cutoff, granularity, now)
+                    if oldest is not None:
+                        changes[item] = oldest
+                self._fdb.commit()
+                if changes:
+                    self._series_cache.changed(changes)
+            except Exception as e:
+                self.logger.exception("problem packing sqlite database: {} period: {}".format(e, cutoff))
+                self._fdb.rollback()
+                return False
+            finally:
+                self._fdb_lock.release()
+            time.sleep(0.01)  # let waiting dumps and queries in
+        return True
+
+    def _pack_item(self, item, lower, cutoff, granularity, now):
+        # returns the oldest time of the packed rows, None if nothing was packed
+        upper = self._fdb.execute(self._next_query, (item, cutoff)).fetchone()[0]
+        if upper is None:
+            upper = now
+        rows = self._fdb.execute(self._pack_rows_query, (item, lower, cutoff)).fetchall()
+        delete = []
+        insert = []
+        for bucket, group in itertools.groupby(rows, key=lambda row: row[0] // granularity):
+            group = list(group)
+            if len(group) > 1:
+                gtime, gavg, gmin, gmax, gpower = zip(*group)
+                _time, _avg, _power = self.__pack(gtime, gavg, gpower, upper)
+                insert.append((_time, item, _avg, min(gmin), max(gmax), _power))
+                delete.append((item, bucket * granularity, min((bucket + 1) * granularity, cutoff)))
+            upper = group[-1][0]
+        self._fdb.executemany("DELETE FROM history WHERE item = ? AND time >= ? AND time < ?;", delete)
+        self._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
+        if delete:
+            return min(row[1] for row in delete)
+
+    def _vacuum(self):
+        free = None
+        while True:
+            if not self._fdb_lock.acquire(timeout=10):
+                return
+            try:
+                if not self.connected:
+                    return
+                pages = self._fdb.execute("PRAGMA freelist_count;").fetchone()[0]
+                if pages == 0 or pages == free:
+                    self._fdb.execute("PRAGMA shrink_memory;")
+                    return
+                free = pages
+                # execute() would only step once and free a single page
+                self._fdb.executescript("PRAGMA incremental_vacuum({});".format(self._vacuum_pages))
+            except Exception as e:
+                self.logger.warning("SQLite: problem vacuuming database: {}".format(e))
+                return
+            finally:
+                self._fdb_lock.release()
+            time.sleep(0.01)
+
     def __pack(self, gtime, gavg, gpower, end):
         asum = 0.0
         psum = 0.0
@@ -321,12 +514,12 @@ class SQL(SmartPlugin):
             sid = item + '|' + func + '|' + start + '|' + end
         istart = self._get_timestamp(start)
         iend = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item='{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, istart))
+        prev = self._fetchone(self._prev_query, (item, istart))
         if not prev:
             first = istart
         else:
             first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time <= {2}".format(item, first, iend)
+        where = " from history WHERE item = ? AND time >= ? AND time <= ?"
         if step is None:
             if count != 0:
                 step = (iend - istart) / count
@@ -335,7 +528,7 @@ class SQL(SmartPlugin):
         reply = {'cmd': 'series', 'series': None, 'sid': sid}
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': iend, 'end': end, 'step': step, 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=int(step / 1000))
-        where += " GROUP by CAST((time / {0}) AS INTEGER)".format(step)
+        where += " GROUP by CAST((time / ?) AS INTEGER)"
         if func == 'avg':
             query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(avg), 2)" + where + " ORDER BY time DESC"
         elif func == 'min':
@@ -346,7 +539,11 @@ class SQL(SmartPlugin):
             query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(power), 2)" + where + " ORDER BY time DESC"
         else:
             raise NotImplementedError
-        tuples = self._fetchall(query)
+        if update or step <= 0 or self._series_cache.size <= 0:
+            tuples = self._fetchall(query, (item, first, iend, step))
+        else:
+            fetch = lambda lo, hi: self._fetchall(query, (item, first if lo is None else lo, hi, step))
+            tuples = self._series_cache.get((item, func, start, end, step), fetch, first, iend, step)
         if not tuples:
             if not update:
                 reply['series'] = [(iend, 0)]
@@ -363,12 +560,12 @@ class SQL(SmartPlugin):
     def _single(self, func, start, end='now', item=None):
         start = self._get_timestamp(start)
         end = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item = '{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, start))
+        prev = self._fetchone(self._prev_query, (item, start))
         if prev is None:
             first = start
         else:
             first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time < {2}".format(item, first, end)
+        where = " from history WHERE item = ? AND time >= ? AND time < ?"
         if func == 'avg':
             query = "SELECT AVG(avg)" + where
         elif func == 'min':
@@ -380,7 +577,7 @@ class SQL(SmartPlugin):
         else:
             self.logger.warning("Unknown export function: {0}".format(func))
             return
-        tuples = self._fetchall(query)
+        tuples = self._fetchall(query, (item, first, end))
         if tuples is None:
             return
         return tuples[0][0]
@@ -26,6 +26,7 @@ import functools
 import time
 import threading
 from lib.model.smartplugin import SmartPlugin
+from plugins.seriescache import SeriesCache
 
 class SQL(SmartPlugin):
 
@@ -51,13 +52,14 @@ class SQL(SmartPlugin):
         GROUP by CAST((_start / {}) AS INTEGER), _item
         ORDER BY _start DESC;"""
 
-    def __init__(self, smarthome, cycle=300, path=None, dumpfile=False):
+    def __init__(self, smarthome, cycle=300, path=None, dumpfile=False, series_cache=100000):
         self.logger = logging.getLogger(__name__)
 #       sqlite3.register_adapter(datetime.datetime, self._timestamp)
         self._sh = smarthome
         self.connected = False
         self._buffer = {}
         self._buffer_lock = threading.Lock()
+        self._series_cache = SeriesCache(int(series_cache))
         self.logger.debug("SQLite {0}".format(sqlite3.sqlite_version))
         self._fdb_lock = threading.Lock()
         self._fdb_lock.acquire()
@@ -114,6 +116,7 @@ class SQL(SmartPlugin):
                 if item[0] not in current_items:
                     self.logger.info("SQLite: deleting entries for {}".format(item[0]))
                     self._execute("DELETE FROM num WHERE _item='{}';".format(item[0]))
+            self._series_cache.clear()
 
     def dump(self, dumpfile):
         self.logger.info("SQLite: dumping database to {}".format(dumpfile))
@@ -129,6 +132,7 @@ class SQL(SmartPlugin):
 
     def move(self, old, new):
         self._execute("UPDATE OR IGNORE num SET _item={} WHERE _item='{}';".format(new, old))
+        self._series_cache.clear()
 
     def parse_item(self, item):
         if 'sqlite' in item.conf:
@@ -278,8 +282,10 @@ class SQL(SmartPlugin):
             self._fdb.commit()
         except Exception as e:
             self.logger.warning("SQLite: problem updating {}: {}".format(item.id(), e))
+            return
         finally:
             self._fdb_lock.release()
+        self._series_cache.changed({item.id(): insert[0]})
 
     def _maintain(self):
         for item in self._buffer:
@@ -292,6 +298,7 @@ class SQL(SmartPlugin):
     def _pack(self):
         if not self._fdb_lock.acquire(timeout=2):
             return
+        changes = {}
         try:
             self.logger.debug("SQLite: pack database")
             for entry in self.periods:
@@ -307,12 +314,16 @@ class SQL(SmartPlugin):
                     self._fdb.execute("INSERT INTO num VALUES (?,?,?,?,?,?,?);", insert)
                     self._fdb.execute("DELETE FROM num WHERE rowid in ({0});".format(gid))
                     self._fdb.commit()
+                    changes[_item] = min(_start, changes.get(_item, _start))
             self._fdb.execute("VACUUM;")
             self._fdb.execute("PRAGMA shrink_memory;")
         except Exception as e:
             self.logger.exception("problem packing sqlite database: {} period: {} type: {}".format(e, period, type(period)))
             self._fdb.rollback()
         finally:
+            # series queries wait for the lock, so the cache is up to date before they run
+            if changes:
+                self._series_cache.changed(changes)
             self._fdb_lock.release()
 
     def _series(self, func, start, end='now', count=100, ratio=1, update=False, step=None, sid=None, item=None):
@@ -329,7 +340,7 @@ class SQL(SmartPlugin):
         reply = {'cmd': 'series', 'series': None, 'sid': sid}
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': iend, 'end': end, 'step': step, 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=int(step / 1000))
-        where = " from num WHERE _item='{0}' AND _start + _dur >= {1} AND _start <= {2} GROUP by CAST((_start / {3}) AS INTEGER)".format(item, istart, iend, step)
+        where = " from num WHERE _item = ? AND _start + _dur >= ? AND _start >= ? AND _start <= ? GROUP by CAST((_start / ?) AS INTEGER)"
         if func == 'avg':
             query = "SELECT MIN(_start), ROUND(SUM(_avg * _dur) / SUM(_dur), 2)" + where + " ORDER BY _start ASC"
         elif func == 'min':
@@ -343,7 +354,11 @@ class SQL(SmartPlugin):
         _item = self._sh.return_item(item)
         if self._buffer[_item] != [] and end == 'now':
             self._insert(_item)
-        tuples = self._fetchall(query)
+        if update or step <= 0 or self._series_cache.size <= 0:
+            tuples = self._fetchall(query, (item, istart, 0, iend, step))
+        else:
+            fetch = lambda lo, hi: self._fetchall(query, (item, istart, 0 if lo is None else lo, hi, step))
+            tuples = self._series_cache.get((item, func, start, end, step), fetch, istart, iend, step)
         if tuples:
             if istart > tuples[0][0]:
                 tuples[0] = (istart, tuples[0][1])
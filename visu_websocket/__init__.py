@@ -23,17 +23,23 @@
 #########################################################################
 
 import base64
+import collections
 import datetime
 import hashlib
+import heapq
+import itertools
 import json
 import logging
 import struct
 import ssl
 import struct
 import threading
+import zlib
+import time
 
 import lib.connection
 from lib.model.smartplugin import SmartPlugin
+from plugins import metrics
 
 
 #########################################################################
@@ -54,7 +60,7 @@ class WebSocket(SmartPlugin):
         return result
 
 
-    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3' ):
+    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3', update_window=50, compression='yes'):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
 
@@ -84,7 +90,15 @@ class WebSocket(SmartPlugin):
             proto = 3
             self.logger.error("WebSocket: Invalid value '"+str(wsproto)+"' configured for attribute wsproto in plugin.conf, using '"+str(proto)+"' instead")
 
-        self.websocket = _websocket(smarthome, ip, port, self.tls, proto)
+        if self.is_int(update_window):
+            window = int(update_window)
+        else:
+            window = 50
+            self.logger.error("WebSocket: Invalid value '"+str(update_window)+"' configured for attribute update_window in plugin.conf, using '"+str(window)+"' instead")
+
+        compression = self.my_to_bool(compression, 'compression', True)
+
+        self.websocket = _websocket(smarthome, ip, port, self.tls, proto, window, compression)
         
 
     def run(self):
@@ -106,7 +120,8 @@ class WebSocket(SmartPlugin):
                 return
             else:
                 acl = 'ro'
-        self.websocket.visu_items[item.id()] = {'acl': acl, 'item': item}
+        immediate = 'visu_immediate' in item.conf and self.to_bool(item.conf['visu_immediate'])
+        self.websocket.visu_items[item.id()] = {'acl': acl, 'item': item, 'immediate': immediate}
         return self.update_item
 
 
@@ -133,16 +148,41 @@ class _websocket(lib.connection.Server):
     Websocket specific class of the Plugin. Handles the websocket connections
     """
 
-    def __init__(self, smarthome, ip, port, tls, wsproto ):
+    def __init__(self, smarthome, ip, port, tls, wsproto, update_window=0, compression=False):
         lib.connection.Server.__init__(self, ip, port)
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.tls = tls
         self.proto = wsproto
+        self.compression = compression
         smarthome.add_event_listener(['log'], self._send_event)
         self.clients = []
         self.visu_items = {}
         self.visu_logics = {}
+        # item path -> tuple of subscribed clients, replaced on change so update_item needs no lock
+        self.monitors = {}
+        self._monitors_lock = threading.Lock()
+        # item updates collected for update_window ms: path -> (value, source)
+        self.update_window = update_window / 1000
+        self._pending = collections.OrderedDict()
+        self._pending_cond = threading.Condition()
+        # the flush worker and immediate items both flush, batches have to go out in order
+        self._flush_lock = threading.Lock()
+        self._flushing = self.update_window > 0
+        if self._flushing:
+            flusher = threading.Thread(target=self._flush_worker, name='WebSocket flush')
+            flusher.daemon = True
+            flusher.start()
+        # series subscriptions shared by all clients: (item, func, sid, step) -> subscription,
+        # refreshed once per update deadline, the earliest deadline on top of the heap
+        self._series = {}
+        self._series_heap = []
+        self._series_seq = itertools.count()
+        self._series_lock = threading.Lock()
+        metrics.gauge('visu_clients', 'Connected websocket clients', fn=lambda: len(self.clients))
+        metrics.gauge('visu_client_backlog_bytes', 'Bytes waiting to be sent to a websocket client', fn=self._backlog, label='client')
+        metrics.gauge('visu_pending_updates', 'Item updates waiting for the update window', fn=lambda: len(self._pending))
+        metrics.gauge('visu_series_subscriptions', 'Series refreshed for the websocket clients', fn=lambda: len(self._series))
 
         self.tls_crt = '/usr/local/smarthome/etc/home.crt'
         self.tls_key = '/usr/local/smarthome/etc/home.key'
@@ -153,6 +193,16 @@ class _websocket(lib.connection.Server):
         for client in self.clients:
             yield client.addr
 
+    def _backlog(self):
+        # bytes queued by lib.connection.Stream.send and not yet written to the socket
+        backlog = {}
+        for client in list(self.clients):
+            try:
+                address = '{0}:{1}'.format(*client.addr)
+            except Exception:
+                address = str(client.addr)
+            backlog[address] = sum(len(data) for data in list(getattr(client, 'outbuffer', ())))
+        return backlog
 
     def handle_connection(self):
         sock, address = self.accept()
@@ -172,6 +222,11 @@ class _websocket(lib.connection.Server):
         self.clients.append(client)
 
     def stop(self):
+        self._flushing = False
+        with self._pending_cond:
+            self._pending_cond.notify()
+        # updates still waiting for the update window go out before the clients are closed
+        self._flush()
         for client in self.clients:
             try:
                 client.close()
@@ -180,15 +235,95 @@ class _websocket(lib.connection.Server):
         self.close()
 
     def update_item(self, item_name, item_value, source):
+        clients = self.monitors.get(item_name)
+        if not clients:
+            return
+        if self._flushing:
+            with self._pending_cond:
+                self._pending.pop(item_name, None)  # keep the order of the latest updates
+                self._pending[item_name] = (item_value, source)
+                self._pending_cond.notify()
+            if self.visu_items.get(item_name, {}).get('immediate'):
+                self._flush()
+            return
         data = {'cmd': 'item', 'items': [[item_name, item_value]]}
 #        self.logger.warning("_websocket: update_item: data {0}".format(data))
-        for client in list(self.clients):
+        self.send_shared(clients, data, source)
+
+    def _flush_worker(self):
+        while self._flushing:
+            with self._pending_cond:
+                while self._flushing and not self._pending:
+                    self._pending_cond.wait(1)
+            time.sleep(self.update_window)
+            self._flush()
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._pending_cond:
+                pending = self._pending
+                self._pending = collections.OrderedDict()
+            if not pending:
+                return
+            batches = collections.OrderedDict()
+            for path, (value, source) in pending.items():
+                for client in self.monitors.get(path, ()):
+                    if client.addr != source:
+                        batches.setdefault(client, []).append(path)
+            # clients showing the same page get the same batch, encode and frame it once
+            payloads = {}
+            frames = {}
+            for client, paths in batches.items():
+                if client.frame is None:
+                    continue
+                paths = tuple(paths)
+                frame = frames.get((paths, client.frame))
+                if frame is None:
+                    payload = payloads.get(paths)
+                    if payload is None:
+                        data = {'cmd': 'item', 'items': [[path, pending[path][0]] for path in paths]}
+                        payload = payloads[paths] = json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()
+                    frame = frames[(paths, client.frame)] = client.frame(payload)
+                try:
+                    client.send(frame)
+                except:
+                    pass
+
+    def send_shared(self, clients, data, source=None):
+        # encode once and send the same frame to every client speaking the same protocol
+        payload = None
+        frames = {}
+        for client in clients:
+            if client.addr == source or client.frame is None:
+                continue
+            if payload is None:
+                payload = json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()
+            frame = frames.get(client.frame)
+            if frame is None:
+                frame = frames[client.frame] = client.frame(payload)
             try:
-                client.update(item_name, data, source)
+                client.send(frame)
             except:
                 pass
 
+    def set_monitor(self, client, paths):
+        with self._monitors_lock:
+            for path in client.monitor['item']:
+                if path in self.monitors:
+                    clients = tuple(c for c in self.monitors[path] if c is not client)
+                    if clients:
+                        self.monitors[path] = clients
+                    else:
+                        del(self.monitors[path])
+            for path in set(paths):
+                self.monitors[path] = self.monitors.get(path, ()) + (client,)
+            client.monitor['item'] = paths
+
     def remove_client(self, client):
+        self.set_monitor(client, [])
+        with self._series_lock:
+            for sid in list(client.series):
+                self._unsubscribe_series(client, sid)
         self.clients.remove(client)
 
 
@@ -199,27 +334,87 @@ class _websocket(lib.connection.Server):
             except:
                 pass
 
+    def subscribe_series(self, client, reply, binary=False, count=None, reducer='none'):
+        params = reply['params']
+        key = (params['item'], params['func'], params['sid'], params['step'])
+        # the client already got everything up to the last value of its reply
+        since = reply['series'][-1][0] if reply['series'] else None
+        with self._series_lock:
+            self._unsubscribe_series(client, params['sid'])
+            subscription = self._series.get(key)
+            if subscription is None:
+                subscription = self._series[key] = {'params': params, 'seq': next(self._series_seq), 'clients': {}}
+                heapq.heappush(self._series_heap, (reply['update'], subscription['seq'], key))
+            subscription['clients'][client] = {'binary': binary, 'count': count, 'reducer': reducer, 'since': since}
+            client.series[params['sid']] = key
+
+    def _unsubscribe_series(self, client, sid):
+        key = client.series.pop(sid, None)
+        subscription = self._series.get(key)
+        if subscription is not None:
+            subscription['clients'].pop(client, None)
+            if not subscription['clients']:
+                del(self._series[key])  # its heap entry is dropped when due
+
     def _update_series(self):
-        for client in list(self.clients):
+        now = self._sh.now()
+        due = []
+        with self._series_lock:
+            while self._series_heap and self._series_heap[0][0] <= now:
+                update, seq, key = heapq.heappop(self._series_heap)
+                subscription = self._series.get(key)
+                if subscription is not None and subscription['seq'] == seq:
+                    due.append((seq, key, subscription))
+        for seq, key, subscription in due:
+            params = subscription['params']
             try:
-                client.update_series()
+                reply = self.visu_items[params['item']]['item'].series(**params)
+                update = reply['update']
             except Exception as e:
-                self.logger.warning("_websocket / _update_series: cannot update client {0}, error {1}".format(client, e))
-                pass
+                self.logger.warning("_websocket / _update_series: cannot update series {0}, error {1}".format(params, e))
+                with self._series_lock:
+                    if self._series.get(key) is subscription:
+                        del(self._series[key])
+                    for client in subscription['clients']:
+                        if client.series.get(params['sid']) == key:
+                            del(client.series[params['sid']])
+                continue
+            with self._series_lock:
+                subscription['params'] = reply['params']
+                clients = list(subscription['clients'].items())
+                if self._series.get(key) is subscription:
+                    heapq.heappush(self._series_heap, (update, seq, key))
+            del(reply['update'])
+            del(reply['params'])
+            if reply['series'] is not None:
+                self._send_series(reply, clients)
+
+    def _send_series(self, reply, clients):
+        # one query for all subscribers, the frame is built once per protocol and reply options
+        frames = {}
+        for client, options in clients:
+            if client.frame is None:
+                continue
+            try:
+                if options['since'] is not None:
+                    # first update after joining a running subscription, skip what the client already got
+                    series = [point for point in reply['series'] if point[0] > options['since']]
+                    options['since'] = None
+                    client.send(client.series_frame(dict(reply, series=series), options['binary'], options['count'], options['reducer']))
+                    continue
+                index = (client.frame, options['binary'], options['count'], options['reducer'])
+                frame = frames.get(index)
+                if frame is None:
+                    frame = frames[index] = client.series_frame(reply, options['binary'], options['count'], options['reducer'])
+                client.send(frame)
+            except Exception as e:
+                self.logger.warning("_websocket / _send_series: cannot update client {0}, error {1}".format(client.addr, e))
 
     def dialog(self, header, content):
-        for client in list(self.clients):
-            try:
-                client.json_send({'cmd': 'dialog', 'header': header, 'content': content})
-            except:
-                pass
+        self.send_shared(list(self.clients), {'cmd': 'dialog', 'header': header, 'content': content})
 
     def url(self, url):
-        for client in list(self.clients):
-            try:
-                client.json_send({'cmd': 'url', 'url': url})
-            except:
-                pass
+        self.send_shared(list(self.clients), {'cmd': 'url', 'url': url})
 
 
 #########################################################################
@@ -240,18 +435,19 @@ class websockethandler(lib.connection.Stream):
         self.header = {}
         self.monitor = {'item': [], 'rrd': [], 'log': []}
         self.monitor_id = {'item': 'item', 'rrd': 'item', 'log': 'name'}
-        self._update_series = {}
+        self.series = {}  # sid -> key of the shared series subscription
         self.items = items
         self.rrd = False
         self.log = False
         self.logs = smarthome.return_logs()
-        self._series_lock = threading.Lock()
         self.logics = logics
         self.proto = proto
         self.logger.info("VISU: Websocket handler uses protocol version {0}".format(self.proto))
         self.sw = ''
         self.swversion = ''
         self.hostname = ''
+        # protocol specific framing of an encoded json payload, set by the handshake
+        self.frame = None
         
 
     def send_event(self, event, data):
@@ -274,34 +470,6 @@ class websockethandler(lib.connection.Stream):
         except:
             pass
 
-    def update(self, path, data, source):
-        if path in self.monitor['item']:
-            if self.addr != source:
-#                self.logger.warning("VISU: update send to {0}: {1}, path={2}, source={3}".format(self.addr, data, path, source))
-                self.json_send(data)
-
-    def update_series(self):
-        now = self._sh.now()
-        self._series_lock.acquire()
-        remove = []
-        for sid, series in self._update_series.items():
-            if series['update'] < now:
-                try:
-                    reply = self.items[series['params']['item']]['item'].series(**series['params'])
-                except Exception as e:
-                    self.logger.exception("Problem updating series for {0}: {1}".format(series['params'], e))
-                    remove.append(sid)
-                    continue
-                self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                del(reply['update'])
-                del(reply['params'])
-                if reply['series'] is not None:
-#                    self.logger.warning("Visu: update send to {0}: {1}".format(self.addr, reply))
-                    self.json_send(reply)
-        for sid in remove:
-            del(self._update_series[sid])
-        self._series_lock.release()
-
     def difference(self, a, b):
         return list(set(b).difference(set(a)))
 
@@ -334,7 +502,7 @@ class websockethandler(lib.connection.Stream):
                     self.logger.warning("Client {0} requested invalid item: {1}".format(self.addr, path))
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'item', 'items': items})))	# MSinn
             self.json_send({'cmd': 'item', 'items': items})
-            self.monitor['item'] = data['items']
+            self._dp.set_monitor(self, data['items'])
         elif command == 'ping':
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'pong'})))
             self.json_send({'cmd': 'pong'})
@@ -361,6 +529,11 @@ class websockethandler(lib.connection.Stream):
                 count = data['count']
             else:
                 count = 100
+            binary = data.get('format') == 'binary'
+            reducer = data.get('reduce', 'minmax' if series in ('min', 'max') else 'lttb')
+            if reducer not in _series_reducers and reducer != 'none':
+                self.logger.warning("Client {0} requested invalid reduction {1} for series {2}, using lttb.".format(self.addr, reducer, path))
+                reducer = 'lttb'
             if path in self.items:
                 if hasattr(self.items[path]['item'], 'series'):
                     try:
@@ -370,13 +543,11 @@ class websockethandler(lib.connection.Stream):
                         self.logger.exception("Problem fetching series for {0}: {1}".format(path, e))
                     else:
                         if 'update' in reply:
-                            self._series_lock.acquire()
-                            self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                            self._series_lock.release()
+                            self._dp.subscribe_series(self, reply, binary, count, reducer)
                             del(reply['update'])
                             del(reply['params'])
                         if reply['series'] is not None:
-                            self.json_send(reply)
+                            self.series_send(reply, binary, count, reducer)
                         else:
                             self.logger.info("WebSocket: no entries for series {} {}".format(path, series))
                 else:
@@ -388,7 +559,15 @@ class websockethandler(lib.connection.Stream):
             if 'max' in data:
                 num = int(data['max'])
             if name in self.logs:
-                self.json_send({'cmd': 'log', 'name': name, 'log': self.logs[name].export(num), 'init': 'y'})
+                if hasattr(self.logs[name], 'export_since'):
+                    # logs with sequence numbers only send what the client has not seen yet
+                    seq, entries = self.logs[name].export_since(int(data['since']) if 'since' in data else None, num)
+                    reply = {'cmd': 'log', 'name': name, 'log': entries, 'seq': seq}
+                    if 'since' not in data:
+                        reply['init'] = 'y'
+                    self.json_send(reply)
+                else:
+                    self.json_send({'cmd': 'log', 'name': name, 'log': self.logs[name].export(num), 'init': 'y'})
             else:
                 self.logger.warning("Client {0} requested invalid log: {1}".format(self.addr, name))
             if name not in self.monitor['log']:
@@ -438,14 +617,48 @@ class websockethandler(lib.connection.Stream):
         self.terminator = 8
         self.found_terminator = self.rfc6455_parse
         self.json_send = self.rfc6455_send
+        self.frame = rfc6455_frame
         key = self.header[b'Sec-WebSocket-Key'] + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
         key = base64.b64encode(hashlib.sha1(key).digest()).decode()
         self.send('HTTP/1.1 101 Switching Protocols\r\n'.encode())
         self.send('Upgrade: websocket\r\n'.encode())
         self.send('Connection: Upgrade\r\n'.encode())
         self.send('Sec-WebSocket-Accept: {0}\r\n'.format(key).encode())
+        if self._dp.compression and b'Sec-WebSocket-Extensions' in self.header:
+            extension = self.rfc7692_negotiate(self.header[b'Sec-WebSocket-Extensions'].decode())
+            if extension is not None:
+                self.send('Sec-WebSocket-Extensions: {0}\r\n'.format(extension).encode())
         self.send('\r\n'.encode())
 
+    def rfc7692_negotiate(self, offers):
+        # accept the first permessage-deflate offer without context takeover in both directions,
+        # so every message is compressed on its own and frames can be shared between clients
+        for offer in offers.split(','):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != 'permessage-deflate':
+                continue
+            bits = 15
+            for param in params[1:]:
+                name, sep, value = param.partition('=')
+                if name.strip() == 'server_max_window_bits':
+                    try:
+                        bits = int(value.strip().strip('"'))
+                    except ValueError:
+                        bits = None
+                    if bits is not None and not 8 <= bits <= 15:
+                        bits = None
+            if bits is None:
+                self.logger.debug("WebSocket: ignoring invalid permessage-deflate offer from {0}: {1}".format(self.addr, offer.strip()))
+                continue
+            if bits == 8:
+                continue  # valid, but zlib has no raw deflate with a window of 256 bytes
+            self.frame = rfc7692_framer(bits)
+            self.logger.debug("WebSocket: permessage-deflate for {0}".format(self.addr))
+            extension = 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+            if bits != 15:
+                extension += '; server_max_window_bits={0}'.format(bits)
+            return extension
+
     def rfc6455_parse(self, data):
         # fin = bit_set(data[0], 7)
         # rsv1 = bit_set(data[0], 6)
@@ -473,41 +686,29 @@ class websockethandler(lib.connection.Stream):
             self.terminator = read
             return
         if masked:
-            key = data[header - 4:header]
-            payload = bytearray(data[header:])
-            for i in range(length):
-                payload[i] ^= key[i % 4]
+            payload = rfc6455_unmask(data[header - 4:header], data[header:read])
         else:
-            payload = data[header:]
+            payload = data[header:read]
+        if data[0] & 0x40 and self.frame is not rfc6455_frame:  # rsv1: compressed message
+            payload = zlib.decompressobj(-15).decompress(bytes(payload) + b'\x00\x00\xff\xff')
         self.json_parse(payload.decode())
         self.terminator = 8
 
+    def series_send(self, reply, binary=False, count=None, reducer='none'):
+        self.send(self.series_frame(reply, binary, count, reducer))
+
+    def series_frame(self, reply, binary=False, count=None, reducer='none'):
+        if reducer in _series_reducers and str(count).isdigit() and len(reply['series']) > int(count):
+            reply = dict(reply, series=_series_reducers[reducer](reply['series'], int(count)))
+        if binary and self.frame is not hixie76_frame:
+            return self.frame(series_binary(reply), 0x02)  # binary frame
+        return self.frame(json.dumps(reply, cls=JSONEncoder, separators=(',', ':')).encode())
+
     def rfc6455_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        header = bytearray(2)
-        header[0] = self.set_bit(header[0], 0)  # opcode text
-        header[0] = self.set_bit(header[0], 7)  # final
-        length = len(data)
-        if length < 126:
-            header[1] = length
-        elif length < ((1 << 16) - 1):
-            header[1] = 126
-            header += bytearray(length.to_bytes(2, byteorder='big'))
-        elif length < ((1 << 64) - 1):
-            header[1] = 127
-            header += bytearray(length.to_bytes(8, byteorder='big'))
-        else:
-            self.logger.warning("data to big: {0}".format(data))
-            return
-        self.send(header + data.encode())
+        self.send(self.frame(json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()))
 
     def hixie76_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        packet = bytearray()
-        packet.append(0x00)
-        packet.extend(data.encode())
-        packet.append(0xff)
-        self.send(packet)
+        self.send(hixie76_frame(json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()))
 
     def hixie76_parse(self, data):
         self.json_parse(data.decode().lstrip('\x00'))
@@ -532,9 +733,165 @@ class websockethandler(lib.connection.Stream):
         self.send(key.digest())
         self.found_terminator = self.hixie76_parse
         self.json_send = self.hixie76_send
+        self.frame = hixie76_frame
         self.terminator = b"\xff"
 
 
+#########################################################################
+
+def rfc6455_frame(payload, opcode=0x01, rsv1=False):
+    header = bytearray(2)
+    header[0] = 0x80 | opcode  # final
+    if rsv1:
+        header[0] |= 0x40
+    length = len(payload)
+    if length < 126:
+        header[1] = length
+    elif length < ((1 << 16) - 1):
+        header[1] = 126
+        header += bytearray(length.to_bytes(2, byteorder='big'))
+    else:
+        header[1] = 127
+        header += bytearray(length.to_bytes(8, byteorder='big'))
+    return bytes(header + payload)
+
+
+def rfc6455_unmask(key, payload):
+    # xor the whole payload at once instead of byte by byte
+    length = len(payload)
+    if length == 0:
+        return b''
+    mask = (bytes(key) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+_rfc7692_framers = {}
+
+
+def rfc7692_framer(bits):
+    # one frame function per window size, so equal frames are shared between clients
+    if bits not in _rfc7692_framers:
+        def rfc7692_frame(payload, opcode=0x01):
+            if len(payload) < 128:  # not worth compressing
+                return rfc6455_frame(payload, opcode)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -bits)
+            payload = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            return rfc6455_frame(payload[:-4], opcode, True)
+        _rfc7692_framers[bits] = rfc7692_frame
+    return _rfc7692_framers[bits]
+
+
+def hixie76_frame(payload):
+    return b'\x00' + payload + b'\xff'
+
+
+def series_runs(reduce):
+    # gaps (None values) must stay gaps, so every run of values between them is reduced on
+    # its own with a share of count by its length, and one None point is kept per gap
+    def reduce_runs(series, count):
+        if len(series) <= count:
+            return series
+        runs = [[]]
+        gaps = []
+        for point in series:
+            if point[1] is not None:
+                runs[-1].append(point)
+            elif runs[-1] or not gaps:
+                gaps.append(point)
+                runs.append([])
+        if not gaps:
+            return reduce(series, count)
+        values = sum(len(run) for run in runs)
+        available = max(count - len(gaps), 0)
+        reduced = [reduce(run, max(int(round(available * len(run) / values)), 1)) if run else run for run in runs]
+        return _join_runs(reduced, gaps)
+    reduce_runs.__name__ = reduce.__name__
+    return reduce_runs
+
+
+def _join_runs(runs, gaps):
+    joined = []
+    for run, gap in zip(runs, gaps):
+        joined.extend(run)
+        joined.append(gap)
+    joined.extend(runs[-1])
+    return joined
+
+
+@series_runs
+def series_lttb(series, count):
+    # largest triangle three buckets: keeps the point of every bucket which spans the
+    # largest triangle with the point kept before and the average of the next bucket
+    if len(series) <= count:
+        return series
+    if count < 3:
+        return [series[0], series[-1]][:max(count, 1)]
+    every = (len(series) - 2) / (count - 2)
+    sampled = [series[0]]
+    a = 0
+    for i in range(count - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        following = series[end:min(int((i + 2) * every) + 1, len(series))]
+        avg_x = sum(point[0] for point in following) / len(following)
+        avg_y = sum(point[1] for point in following) / len(following)
+        ax, ay = series[a]
+        area = -1
+        for j in range(start, end):
+            x, y = series[j]
+            current = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if current > area:
+                area = current
+                a = j
+        sampled.append(series[a])
+    sampled.append(series[-1])
+    return sampled
+
+
+@series_runs
+def series_minmax(series, count):
+    # keeps the first and the last point and the lowest and the highest value of every
+    # bucket in between in time order, so peaks and the time range survive
+    if len(series) <= count:
+        return series
+    if count < 3:
+        return [series[0], series[-1]][:max(count, 1)]
+    inner = series[1:-1]
+    buckets = max((count - 2) // 2, 1)
+    size = len(inner) / buckets
+    sampled = [series[0]]
+    for i in range(buckets):
+        bucket = inner[int(i * size):int((i + 1) * size)]
+        if not bucket:
+            continue
+        low = min(bucket, key=lambda point: point[1])
+        high = max(bucket, key=lambda point: point[1])
+        if low is high:
+            sampled.append(low)
+        elif low[0] < high[0]:
+            sampled.extend((low, high))
+        else:
+            sampled.extend((high, low))
+    sampled.append(series[-1])
+    return sampled
+
+
+_series_reducers = {'lttb': series_lttb, 'minmax': series_minmax}
+
+
+def series_binary(reply):
+    # 4 byte length of a json header, followed by (int64 time, float64 value) pairs, big endian
+    series = reply['series']
+    header = {key: value for key, value in reply.items() if key != 'series'}
+    header['count'] = len(series)
+    header = json.dumps(header, cls=JSONEncoder, separators=(',', ':')).encode()
+    values = []
+    for stamp, value in series:
+        values.append(int(stamp))
+        values.append(float('nan') if value is None else float(value))
+    return struct.pack('>I', len(header)) + header + struct.pack('>' + 'qd' * len(series), *values)
+
+
 #########################################################################
 
 class JSONEncoder(json.JSONEncoder):